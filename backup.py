@@ -0,0 +1,383 @@
+"""Sao lưu tăng dần và khôi phục sổ chi tiêu theo thời điểm.
+
+Tiến trình `tail` đọc change stream của MongoDB (cần replica set) cho các
+collection thuchi_{user_id} và tu_khoa, ghi từng thay đổi vào các file
+segment nén gzip chỉ ghi nối tiếp. Chi phí sao lưu tỉ lệ với lượng thay đổi,
+không phụ thuộc kích thước dữ liệu. `compact` gộp các segment cũ vào một
+snapshot mới (chỉ ghi lại các collection có thay đổi), `restore` dựng lại
+một collection tại một thời điểm từ snapshot gần nhất và các segment sau đó.
+
+Cách dùng:
+    python backup.py init                                   # snapshot đầu tiên
+    python backup.py tail                                   # chạy liên tục cùng bot
+    python backup.py compact                                # gộp segment, xóa dữ liệu quá hạn
+    python backup.py restore --user 123 --until "19/10/2026 08:30"
+"""
+import os
+import sys
+import gzip
+import time
+import argparse
+from datetime import datetime
+from bson import json_util
+from bson.json_util import CANONICAL_JSON_OPTIONS
+from bson.timestamp import Timestamp
+from pymongo import InsertOne
+
+import bot
+
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backup')
+SEGMENT_DIR = os.path.join(BACKUP_DIR, 'segments')
+SNAPSHOT_DIR = os.path.join(BACKUP_DIR, 'snapshots')
+STATE_FILE = os.path.join(BACKUP_DIR, 'state.json')
+
+SEGMENT_MAX_BYTES = int(os.getenv('BACKUP_SEGMENT_MAX_BYTES', 16 * 1024 * 1024))
+SEGMENT_MAX_AGE_S = int(os.getenv('BACKUP_SEGMENT_MAX_AGE_S', 3600))
+FLUSH_INTERVAL_S = float(os.getenv('BACKUP_FLUSH_INTERVAL_S', 1))
+RETENTION_DAYS = int(os.getenv('BACKUP_RETENTION_DAYS', 7))  # Khoảng thời gian có thể khôi phục
+
+# Các collection được sao lưu
+WATCHED_COLLECTIONS = r'^(thuchi_\d+|tu_khoa)$'
+OPERATIONS = {'insert': 'i', 'replace': 'r', 'update': 'u', 'delete': 'd', 'drop': 'x'}
+
+def dumps(value) -> str:
+    return json_util.dumps(value, json_options=CANONICAL_JSON_OPTIONS)
+
+def loads(line: str):
+    return json_util.loads(line)
+
+def ts_key(ts: Timestamp) -> str:
+    """Tên file sắp xếp được theo thời gian."""
+    return f'{ts.time:010d}-{ts.inc:08d}'
+
+def write_json(path: str, value):
+    """Ghi file JSON nhỏ một cách atomic."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(dumps(value))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_json(path: str, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return loads(f.read())
+
+def list_snapshots() -> list:
+    """Danh sách meta của các snapshot, cũ nhất trước."""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    return [read_json(os.path.join(SNAPSHOT_DIR, name, 'meta.json')) for name in sorted(os.listdir(SNAPSHOT_DIR))
+            if os.path.exists(os.path.join(SNAPSHOT_DIR, name, 'meta.json'))]
+
+def list_segments() -> list:
+    """Danh sách meta của các segment đã có dữ liệu, cũ nhất trước."""
+    if not os.path.isdir(SEGMENT_DIR):
+        return []
+    return [read_json(os.path.join(SEGMENT_DIR, name)) for name in sorted(os.listdir(SEGMENT_DIR))
+            if name.endswith('.meta.json')]
+
+def read_events(segment: dict):
+    with gzip.open(os.path.join(SEGMENT_DIR, segment['file']), 'rt') as f:
+        for line in f:
+            yield loads(line)
+
+def read_snapshot_collection(snapshot: dict, collection_name: str) -> dict:
+    """Đọc một collection trong snapshot thành dict _id -> document."""
+    docs = {}
+    if collection_name not in snapshot['collections']:
+        return docs
+    with gzip.open(os.path.join(SNAPSHOT_DIR, snapshot['name'], f'{collection_name}.jsonl.gz'), 'rt') as f:
+        for line in f:
+            doc = loads(line)
+            docs[dumps(doc['_id'])] = doc
+    return docs
+
+def write_snapshot_collection(snapshot_path: str, collection_name: str, docs):
+    with gzip.open(os.path.join(snapshot_path, f'{collection_name}.jsonl.gz'), 'wt') as f:
+        for doc in docs:
+            f.write(dumps(doc) + '\n')
+
+def set_path(doc: dict, path: str, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+def unset_path(doc: dict, path: str):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        doc = doc.get(key)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(keys[-1], None)
+
+def apply_event(docs: dict, event: dict):
+    """Áp dụng một thay đổi lên dict _id -> document (áp dụng lại nhiều lần cho cùng kết quả)."""
+    key = dumps(event.get('id'))
+    if event['op'] in ('i', 'r'):
+        docs[key] = event['doc']
+    elif event['op'] == 'u':
+        doc = docs.get(key)
+        if doc is None:
+            return
+        for path, value in event.get('set', {}).items():
+            set_path(doc, path, value)
+        for path in event.get('unset', []):
+            unset_path(doc, path)
+    elif event['op'] == 'd':
+        docs.pop(key, None)
+    elif event['op'] == 'x':
+        docs.clear()
+
+class SegmentWriter:
+    """Ghi thay đổi vào segment hiện tại, mỗi lần flush nối thêm một gzip member."""
+
+    def __init__(self):
+        os.makedirs(SEGMENT_DIR, exist_ok=True)
+        self.segment = None
+        self.buffer = []
+        self.saved_token = None  # Resume token đã ghi vào STATE_FILE
+
+    def add(self, event: dict):
+        self.buffer.append(event)
+
+    def flush(self, resume_token):
+        if self.buffer:
+            if self.segment is None or self.should_rotate():
+                first_ts = self.buffer[0]['ts']
+                self.segment = {
+                    'file': f'{ts_key(first_ts)}.jsonl.gz',
+                    'first_ts': first_ts,
+                    'created_at': time.time(),
+                    'collections': []
+                }
+            path = os.path.join(SEGMENT_DIR, self.segment['file'])
+            data = ''.join(dumps(event) + '\n' for event in self.buffer)
+            with open(path, 'ab') as f:
+                f.write(gzip.compress(data.encode()))
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.segment['last_ts'] = self.buffer[-1]['ts']
+            self.segment['collections'] = sorted(set(self.segment['collections']) |
+                                                 {event['coll'] for event in self.buffer})
+            write_json(os.path.join(SEGMENT_DIR, self.segment['file'].replace('.jsonl.gz', '.meta.json')),
+                       self.segment)
+            self.buffer = []
+        # Chỉ lưu resume token sau khi thay đổi đã nằm trên đĩa, và chỉ khi token thay đổi
+        # để tail không fsync liên tục khi không có thay đổi nào
+        if resume_token is not None and resume_token != self.saved_token:
+            write_json(STATE_FILE, {'resume_token': resume_token})
+            self.saved_token = resume_token
+
+    def should_rotate(self) -> bool:
+        path = os.path.join(SEGMENT_DIR, self.segment['file'])
+        return (os.path.getsize(path) >= SEGMENT_MAX_BYTES or
+                time.time() - self.segment['created_at'] >= SEGMENT_MAX_AGE_S)
+
+def to_event(change: dict) -> dict:
+    """Chuyển một change event thành bản ghi gọn để lưu vào segment."""
+    event = {
+        'ts': change['clusterTime'],
+        'coll': change['ns']['coll'],
+        'op': OPERATIONS[change['operationType']]
+    }
+    if 'documentKey' in change:
+        event['id'] = change['documentKey']['_id']
+    if event['op'] in ('i', 'r'):
+        event['doc'] = change['fullDocument']
+    elif event['op'] == 'u':
+        description = change['updateDescription']
+        event['set'] = description.get('updatedFields', {})
+        event['unset'] = description.get('removedFields', [])
+    return event
+
+def init():
+    """Tạo snapshot đầu tiên và điểm bắt đầu cho tail."""
+    if read_json(STATE_FILE):
+        sys.exit('❌ Đã khởi tạo sao lưu, dùng "tail" để tiếp tục')
+
+    # Lấy thời điểm trước khi dump: các thay đổi trong lúc dump sẽ được tail áp dụng lại
+    ping = bot.client.admin.command('ping')
+    if 'operationTime' not in ping:
+        sys.exit('❌ Sao lưu dùng change stream nên cần MongoDB chạy replica set')
+    start_ts = ping['operationTime']
+    name = ts_key(start_ts)
+    snapshot_path = os.path.join(SNAPSHOT_DIR, name)
+    os.makedirs(snapshot_path, exist_ok=True)
+
+    collections = sorted(bot.db.list_collection_names(filter={'name': {'$regex': WATCHED_COLLECTIONS}}))
+    for collection_name in collections:
+        write_snapshot_collection(snapshot_path, collection_name, bot.db[collection_name].find())
+        print(f'✅ {collection_name}')
+    write_json(os.path.join(snapshot_path, 'meta.json'), {'name': name, 'ts': start_ts, 'collections': collections})
+    write_json(STATE_FILE, {'start_at': start_ts})
+    print(f'✅ Đã tạo snapshot đầu tiên với {len(collections)} collection')
+
+def tail():
+    """Đọc change stream liên tục và ghi vào segment."""
+    state = read_json(STATE_FILE)
+    if not state:
+        sys.exit('❌ Chưa khởi tạo sao lưu, hãy chạy "init" trước')
+
+    options = {}
+    if 'resume_token' in state:
+        options['resume_after'] = state['resume_token']
+    else:
+        options['start_at_operation_time'] = state['start_at']
+
+    pipeline = [{'$match': {
+        'ns.coll': {'$regex': WATCHED_COLLECTIONS},
+        'operationType': {'$in': list(OPERATIONS)}
+    }}]
+    writer = SegmentWriter()
+    writer.saved_token = state.get('resume_token')
+    print('🔄 Đang sao lưu thay đổi...')
+    with bot.db.watch(pipeline, **options) as stream:
+        last_flush = time.monotonic()
+        try:
+            while stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    writer.add(to_event(change))
+                if change is None or time.monotonic() - last_flush >= FLUSH_INTERVAL_S:
+                    writer.flush(stream.resume_token)
+                    last_flush = time.monotonic()
+                    if change is None:
+                        time.sleep(0.2)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            writer.flush(stream.resume_token)
+
+def compact():
+    """Gộp các segment đã đóng vào snapshot mới và xóa dữ liệu ngoài khoảng lưu giữ."""
+    snapshots = list_snapshots()
+    if not snapshots:
+        sys.exit('❌ Chưa có snapshot, hãy chạy "init" trước')
+    base = snapshots[-1]
+
+    # Bỏ qua segment mới nhất vì tail có thể vẫn đang ghi vào
+    segments = [s for s in list_segments()[:-1] if s['last_ts'] > base['ts']]
+    if segments:
+        new_ts = segments[-1]['last_ts']
+        name = ts_key(new_ts)
+        snapshot_path = os.path.join(SNAPSHOT_DIR, name)
+        os.makedirs(snapshot_path, exist_ok=True)
+
+        touched = set().union(*(s['collections'] for s in segments))
+        collections = set(base['collections']) | touched
+        for collection_name in sorted(collections):
+            if collection_name not in touched:
+                # Collection không đổi: dùng lại file cũ, không tốn chi phí ghi
+                os.link(os.path.join(SNAPSHOT_DIR, base['name'], f'{collection_name}.jsonl.gz'),
+                        os.path.join(snapshot_path, f'{collection_name}.jsonl.gz'))
+                continue
+            docs = read_snapshot_collection(base, collection_name)
+            for segment in segments:
+                if collection_name in segment['collections']:
+                    for event in read_events(segment):
+                        if event['coll'] == collection_name and event['ts'] > base['ts']:
+                            apply_event(docs, event)
+            write_snapshot_collection(snapshot_path, collection_name, docs.values())
+        write_json(os.path.join(snapshot_path, 'meta.json'),
+                   {'name': name, 'ts': new_ts, 'collections': sorted(collections)})
+        print(f'✅ Đã gộp {len(segments)} segment, ghi lại {len(touched)}/{len(collections)} collection')
+        snapshots = list_snapshots()
+
+    # Giữ snapshot mới nhất trước mốc lưu giữ và mọi thứ sau nó
+    cutoff = time.time() - RETENTION_DAYS * 86400
+    keep = [s for s in snapshots if s['ts'].time <= cutoff][-1:] or snapshots[:1]
+    for snapshot in snapshots:
+        if snapshot['ts'] < keep[0]['ts']:
+            for file_name in os.listdir(os.path.join(SNAPSHOT_DIR, snapshot['name'])):
+                os.remove(os.path.join(SNAPSHOT_DIR, snapshot['name'], file_name))
+            os.rmdir(os.path.join(SNAPSHOT_DIR, snapshot['name']))
+            print(f'🗑️ Đã xóa snapshot {snapshot["name"]}')
+    for segment in list_segments():
+        if segment['last_ts'] <= keep[0]['ts']:
+            os.remove(os.path.join(SEGMENT_DIR, segment['file']))
+            os.remove(os.path.join(SEGMENT_DIR, segment['file'].replace('.jsonl.gz', '.meta.json')))
+            print(f'🗑️ Đã xóa segment {segment["file"]}')
+
+def restore(collection_name: str, until: datetime, target: str, dry_run: bool):
+    """Dựng lại một collection như ngay trước thời điểm until và ghi vào collection target."""
+    # Trạng thái ngay trước thời điểm until
+    until_ts = Timestamp(int(until.timestamp()), 0)
+    snapshots = [s for s in list_snapshots() if s['ts'] < until_ts]
+    if not snapshots:
+        sys.exit('❌ Không có snapshot nào trước thời điểm này')
+    base = snapshots[-1]
+
+    docs = read_snapshot_collection(base, collection_name)
+    event_count = 0
+    for segment in list_segments():
+        if collection_name not in segment['collections'] or segment['last_ts'] <= base['ts']:
+            continue
+        if segment['first_ts'] >= until_ts:
+            break
+        for event in read_events(segment):
+            if event['coll'] == collection_name and base['ts'] < event['ts'] < until_ts:
+                apply_event(docs, event)
+                event_count += 1
+
+    print(f'📦 {collection_name} tại {until.strftime("%d/%m/%Y %H:%M")}: {len(docs)} bản ghi '
+          f'(snapshot {base["name"]} + {event_count} thay đổi)')
+    if dry_run:
+        return
+
+    collection = bot.db[target]
+    collection.delete_many({})
+    if docs:
+        collection.bulk_write([InsertOne(doc) for doc in docs.values()], ordered=False)
+    print(f'✅ Đã khôi phục vào {target}')
+
+    # Tính lại bản tổng hợp theo tháng của người dùng
+    if target.startswith('thuchi_') and target[len('thuchi_'):].isdigit():
+        user_id = int(target[len('thuchi_'):])
+        for month in sorted({doc['month'] for doc in docs.values() if 'month' in doc}):
+            bot.tong_danh_muc_collection.update_one(
+                {'_id': bot.category_total_id(user_id, month)},
+                {'$set': {
+                    'tong': bot.compute_category_totals(user_id, month),
+                    'ngay': bot.compute_daily_totals(user_id, month)
+                }}
+            )
+        bot.sync_category_totals(user_id, datetime.now().strftime('%Y-%m'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Sao lưu tăng dần và khôi phục sổ chi tiêu')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('init', help='Tạo snapshot đầu tiên')
+    subparsers.add_parser('tail', help='Ghi liên tục các thay đổi vào segment')
+    subparsers.add_parser('compact', help='Gộp segment vào snapshot và xóa dữ liệu quá hạn')
+    restore_parser = subparsers.add_parser('restore', help='Khôi phục một collection tại một thời điểm')
+    restore_parser.add_argument('--user', type=int, help='user_id cần khôi phục (collection thuchi_{user_id})')
+    restore_parser.add_argument('--collection', help='Tên collection cần khôi phục, ví dụ tu_khoa')
+    restore_parser.add_argument('--until', required=True, help='Thời điểm khôi phục "dd/mm/yyyy HH:MM"')
+    restore_parser.add_argument('--target', help='Collection đích (mặc định ghi đè collection gốc)')
+    restore_parser.add_argument('--dry-run', action='store_true', help='Chỉ thống kê, không ghi dữ liệu')
+    restore_parser.add_argument('--yes', action='store_true', help='Xác nhận ghi đè collection gốc')
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        init()
+    elif args.command == 'tail':
+        tail()
+    elif args.command == 'compact':
+        compact()
+    else:
+        collection_name = f'thuchi_{args.user}' if args.user else args.collection
+        if not collection_name:
+            sys.exit('❌ Cần --user hoặc --collection')
+        target = args.target or collection_name
+        if target == collection_name and not args.dry_run and not args.yes:
+            sys.exit(f'❌ Lệnh này sẽ ghi đè {collection_name}, thêm --yes để xác nhận hoặc dùng --target')
+        until = datetime.strptime(args.until, '%d/%m/%Y %H:%M')
+        restore(collection_name, until, target, args.dry_run)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Đo thời gian chuẩn bị bản tin (prepare_digests) cho nhiều người dùng.
+
+Script tạo một database riêng, sinh N cài đặt bản tin (ban_tin) đã đến hạn và
+bản tổng hợp tháng (tong_danh_muc) tương ứng, rồi đo thời gian nhận và tạo nội
+dung bản tin. Database được xóa sau khi chạy (trừ khi dùng --keep).
+
+Cách dùng (cần một mongod đang chạy):
+    MONGODB_URI=mongodb://localhost:27017 python bench_digests.py --users 100000
+
+Server mặc định chạy ở UTC còn người dùng ở DIGEST_DEFAULT_TZ; số lệnh aggregate
+trong thống kê cuối phải là 0 (không tính từ sổ chi tiêu cho từng người).
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Đo thời gian chuẩn bị bản tin chi tiêu')
+    parser.add_argument('--users', type=int, default=100000, help='Số người dùng (mặc định 100000)')
+    parser.add_argument('--weekly-ratio', type=float, default=0.2, help='Tỉ lệ người nhận bản tin tuần')
+    parser.add_argument('--db', default='bench_ban_tin', help='Database dùng để đo (sẽ bị xóa)')
+    parser.add_argument('--keep', action='store_true', help='Giữ lại database sau khi đo')
+    parser.add_argument('--server-tz', default='UTC', help='Múi giờ của server khi đo (mặc định UTC)')
+    return parser.parse_args()
+
+args = parse_args()
+if args.db == os.getenv('DATABASE_NAME'):
+    sys.exit('❌ --db phải khác DATABASE_NAME của bot')
+
+# Đặt trước khi import bot: bot đọc DATABASE_NAME lúc import. Mặc định server chạy
+# UTC, khác múi giờ của người dùng, để đo đúng trường hợp ghép ngày từ tổng theo giờ.
+os.environ['DATABASE_NAME'] = args.db
+os.environ['DIGEST_ENABLED'] = '0'
+os.environ['TZ'] = args.server_tz
+time.tzset()
+
+import bot
+
+def seed(users: int, weekly_ratio: float, now_utc: datetime):
+    """Sinh cài đặt bản tin đã đến hạn và bản tổng hợp (theo giờ) của tháng này và tháng trước."""
+    today = datetime.now()
+    months = [today.strftime('%Y-%m'), (today.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')]
+    days_in_month = ['%02d' % d for d in range(1, 29)]
+    hours_in_day = ['%02d' % h for h in range(24)]
+    random.seed(0)
+
+    settings, summaries = [], []
+    for user_id in range(1, users + 1):
+        settings.append({
+            '_id': user_id,
+            'chat_id': user_id,
+            'tan_suat': 'tuan' if random.random() < weekly_ratio else 'ngay',
+            'gio': 21,
+            'mui_gio': bot.DIGEST_DEFAULT_TZ,
+            'bat': True,
+            'lan_gui_tiep': now_utc - timedelta(minutes=1)
+        })
+        for month in months:
+            ngay = {
+                day: {
+                    hour: {danh_muc: random.randint(1, 50) * 10000}
+                    for hour, danh_muc in zip(random.sample(hours_in_day, 3), random.sample(bot.CATEGORIES, 3))
+                }
+                for day in days_in_month
+            }
+            tong = {}
+            for theo_gio in ngay.values():
+                for theo_danh_muc in theo_gio.values():
+                    for danh_muc, so_tien in theo_danh_muc.items():
+                        tong[danh_muc] = tong.get(danh_muc, 0) + so_tien
+            summaries.append({
+                '_id': bot.category_total_id(user_id, month),
+                'user_id': user_id,
+                'month': month,
+                'tong': tong,
+                'ngay': ngay,
+                'han_muc': {},
+                'so_du': 50000000 - sum(tong.values())
+            })
+        if len(summaries) >= 10000:
+            bot.tong_danh_muc_collection.insert_many(summaries, ordered=False)
+            summaries = []
+        if len(settings) >= 10000:
+            bot.ban_tin_collection.insert_many(settings, ordered=False)
+            settings = []
+    if summaries:
+        bot.tong_danh_muc_collection.insert_many(summaries, ordered=False)
+    if settings:
+        bot.ban_tin_collection.insert_many(settings, ordered=False)
+
+def main():
+    now_utc = datetime.now(timezone.utc)
+    try:
+        started_at = time.perf_counter()
+        seed(args.users, args.weekly_ratio, now_utc)
+        print(f'🌱 Đã sinh {args.users:,} người dùng trong {time.perf_counter() - started_at:.1f} s')
+
+        started_at = time.perf_counter()
+        messages = bot.prepare_digests(now_utc)
+        elapsed = time.perf_counter() - started_at
+
+        print(f'⏱️ prepare_digests: {len(messages):,} bản tin trong {elapsed:.2f} s '
+              f'({elapsed / max(len(messages), 1) * 1000000:.0f} µs/người dùng)')
+        print(f'📨 Gửi với {bot.DIGEST_RATE_PER_S:g} tin/giây mất khoảng '
+              f'{len(messages) / bot.DIGEST_RATE_PER_S / 60:.1f} phút (chạy ở task riêng)')
+        print(bot.db_monitor.format_stats())
+    finally:
+        if not args.keep:
+            bot.client.drop_database(args.db)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,20 @@
 import os
+import re
+import time
+import asyncio
 import logging
-from datetime import datetime
+import functools
+import threading
+import contextvars
+import unicodedata
+import uuid
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from pymongo import MongoClient
+from telegram.error import Forbidden, RetryAfter
+from pymongo import MongoClient, InsertOne, UpdateOne, ReturnDocument, WriteConcern, monitoring
 import matplotlib.pyplot as plt
 import io
 
@@ -38,19 +48,217 @@ CATEGORY_EMOJIS = {
 # Danh sách các danh mục
 CATEGORIES = list(CATEGORY_EMOJIS.keys())
 
+# Giám sát truy vấn MongoDB
+MONGO_SLOW_MS = float(os.getenv('MONGO_SLOW_MS', 100))  # Ngưỡng truy vấn chậm (ms)
+MONGO_EXPLAIN_SLOW = os.getenv('MONGO_EXPLAIN_SLOW', '0') == '1'  # Chạy explain cho truy vấn chậm
+MONGO_ROUND_TRIP_BUDGET = int(os.getenv('MONGO_ROUND_TRIP_BUDGET', 0))  # Số round trip tối đa cho mỗi update (0 = tắt)
+MONGO_BUDGET_STRICT = os.getenv('MONGO_BUDGET_STRICT', '0') == '1'  # Báo lỗi thay vì cảnh báo (dùng khi test)
+
+# Các lệnh nội bộ của driver, không tính vào thống kê
+IGNORED_COMMANDS = {'ping', 'hello', 'ismaster', 'isMaster', 'endSessions', 'explain', 'saslStart', 'saslContinue'}
+EXPLAINABLE_COMMANDS = {'find', 'count', 'distinct', 'aggregate', 'update', 'delete', 'findAndModify'}
+
+# Thống kê của update Telegram đang được xử lý
+current_update_stats = contextvars.ContextVar('current_update_stats', default=None)
+
+class RoundTripBudgetExceeded(Exception):
+    """Một update dùng nhiều round trip MongoDB hơn mức cho phép."""
+
+def filter_shape(value):
+    """Thay giá trị trong filter bằng kiểu dữ liệu, chỉ giữ lại cấu trúc."""
+    if isinstance(value, dict):
+        return {k: filter_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [filter_shape(v) for v in value[:3]]
+    return type(value).__name__
+
+def command_filter(command_name: str, command: dict):
+    """Lấy filter từ một lệnh MongoDB."""
+    if command_name in ('update', 'delete'):
+        key = 'updates' if command_name == 'update' else 'deletes'
+        return [op.get('q') for op in command.get(key, [])]
+    if command_name == 'aggregate':
+        return command.get('pipeline')
+    return command.get('filter', command.get('query'))
+
+class MongoCommandMonitor(monitoring.CommandListener):
+    """Ghi nhận thời gian của từng lệnh MongoDB và gán số round trip cho update đang chạy."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # request_id -> (command_name, collection, command, update_stats)
+        self.stats = {}  # command_name -> {'count', 'total_ms', 'max_ms'}
+        self.servers = {}  # 'host:port' -> số lệnh, để kiểm tra phân luồng đọc
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        update_stats = current_update_stats.get()
+        if update_stats is not None:
+            update_stats['round_trips'] += 1
+            update_stats['commands'][event.command_name] = update_stats['commands'].get(event.command_name, 0) + 1
+        command = {k: v for k, v in event.command.items()
+                   if not k.startswith('$') and k not in ('lsid', 'txnNumber', 'documents')}
+        collection = event.command.get(event.command_name)
+        server = '%s:%s' % event.connection_id
+        with self.lock:
+            self.servers[server] = self.servers.get(server, 0) + 1
+            self.pending[event.request_id] = (event.command_name, collection, command, update_stats)
+
+    def succeeded(self, event):
+        self.finish(event)
+
+    def failed(self, event):
+        self.finish(event)
+
+    def finish(self, event):
+        with self.lock:
+            pending = self.pending.pop(event.request_id, None)
+            if pending is None:
+                return
+            command_name, collection, command, update_stats = pending
+            duration_ms = event.duration_micros / 1000
+            stat = self.stats.setdefault(command_name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            stat['count'] += 1
+            stat['total_ms'] += duration_ms
+            stat['max_ms'] = max(stat['max_ms'], duration_ms)
+
+        if duration_ms >= MONGO_SLOW_MS:
+            logger.warning(
+                'Truy vấn chậm: %s %s.%s (%.1f ms) filter=%s',
+                command_name, event.database_name, collection, duration_ms,
+                filter_shape(command_filter(command_name, command))
+            )
+            if MONGO_EXPLAIN_SLOW and update_stats is not None and command_name in EXPLAINABLE_COMMANDS:
+                # Không chạy explain ngay trong listener, để dành đến khi update xử lý xong
+                update_stats['slow_commands'].append((event.database_name, command))
+
+    def format_stats(self) -> str:
+        """Tạo bảng thống kê độ trễ theo từng lệnh."""
+        with self.lock:
+            items = sorted(self.stats.items(), key=lambda x: x[1]['total_ms'], reverse=True)
+            servers = sorted(self.servers.items())
+        if not items:
+            return '📈 Chưa có truy vấn nào được ghi nhận!'
+        message = '📈 Thống kê truy vấn MongoDB:\n\n'
+        for command_name, stat in items:
+            avg_ms = stat['total_ms'] / stat['count']
+            message += f'• {command_name}: {stat["count"]} lần, TB {avg_ms:.1f} ms, max {stat["max_ms"]:.1f} ms\n'
+        message += '\n🖥️ Theo server:\n'
+        for server, count in servers:
+            message += f'• {server}: {count} lệnh\n'
+        return message
+
+db_monitor = MongoCommandMonitor()
+
+def explain_summary(database_name: str, command: dict) -> str:
+    """Tóm tắt kế hoạch thực thi (ví dụ: FETCH <- IXSCAN) của một lệnh."""
+    result = client[database_name].command({'explain': command, 'verbosity': 'queryPlanner'})
+    plan = result.get('queryPlanner', {}).get('winningPlan', {})
+    stages = []
+    while plan:
+        stage = plan.get('stage', '')
+        if plan.get('indexName'):
+            stage += f'({plan["indexName"]})'
+        stages.append(stage)
+        plan = plan.get('inputStage') or plan.get('queryPlan')
+    return ' <- '.join(s for s in stages if s) or 'không rõ'
+
+def track_db_usage(handler):
+    """Đếm số round trip MongoDB của mỗi update và cảnh báo khi vượt ngân sách."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        update_stats = {'round_trips': 0, 'commands': {}, 'slow_commands': []}
+        token = current_update_stats.set(update_stats)
+        started_at = time.perf_counter()
+        handler_failed = True
+        try:
+            result = await handler(update, context)
+            handler_failed = False
+            return result
+        finally:
+            current_update_stats.reset(token)
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            label = handler.__name__
+            if update.callback_query:
+                label += f':{update.callback_query.data}'
+
+            for database_name, command in update_stats['slow_commands']:
+                try:
+                    logger.warning('Explain %s: %s', label, explain_summary(database_name, command))
+                except Exception as e:
+                    logger.warning('Không thể explain truy vấn chậm: %s', e)
+
+            logger.debug('%s: %d round trip trong %.1f ms', label, update_stats['round_trips'], elapsed_ms)
+            if MONGO_ROUND_TRIP_BUDGET and update_stats['round_trips'] > MONGO_ROUND_TRIP_BUDGET:
+                message = (
+                    f'{label} (user {update.effective_user.id if update.effective_user else "?"}) '
+                    f'dùng {update_stats["round_trips"]} round trip, vượt ngân sách {MONGO_ROUND_TRIP_BUDGET}: '
+                    f'{update_stats["commands"]}'
+                )
+                # Không che lỗi thật của handler bằng lỗi vượt ngân sách
+                if MONGO_BUDGET_STRICT and not handler_failed:
+                    raise RoundTripBudgetExceeded(message)
+                logger.warning(message)
+    return wrapper
+
+# Phân luồng đọc báo cáo sang secondary
+READ_ROUTING = os.getenv('READ_ROUTING', '0') == '1'
+MONGODB_REPORT_URI = os.getenv('MONGODB_REPORT_URI') or os.getenv('MONGODB_URI')
+REPORT_READ_PREFERENCE = os.getenv('REPORT_READ_PREFERENCE', 'secondaryPreferred')
+REPORT_MAX_STALENESS_S = int(os.getenv('REPORT_MAX_STALENESS_S', 90))  # MongoDB yêu cầu tối thiểu 90 giây
+REPORT_MAX_POOL_SIZE = int(os.getenv('REPORT_MAX_POOL_SIZE', 20))
+REPORT_TIMEOUT_MS = int(os.getenv('REPORT_TIMEOUT_MS', 30000))
+WRITE_MAX_POOL_SIZE = int(os.getenv('WRITE_MAX_POOL_SIZE', 100))
+WRITE_TIMEOUT_MS = os.getenv('WRITE_TIMEOUT_MS')  # Không đặt thì dùng mặc định của driver (không timeout)
+
 # MongoDB connection
 try:
-    client = MongoClient(os.getenv('MONGODB_URI'))
+    # Client chính: ghi dữ liệu và các lệnh cần đọc ngay sau khi ghi, luôn dùng primary.
+    # Client này cũng được các script bảo trì (recategorize.py, backup.py) dùng cho các
+    # lệnh chạy lâu, nên chỉ đặt timeout khi được cấu hình rõ ràng.
+    timeouts = {}
+    if WRITE_TIMEOUT_MS:
+        timeouts = {'serverSelectionTimeoutMS': int(WRITE_TIMEOUT_MS), 'socketTimeoutMS': int(WRITE_TIMEOUT_MS)}
+    client = MongoClient(
+        os.getenv('MONGODB_URI'),
+        event_listeners=[db_monitor],
+        readPreference='primary',
+        maxPoolSize=WRITE_MAX_POOL_SIZE,
+        **timeouts
+    )
     # Test the connection
     client.admin.command('ping')
     print("✅ Kết nối MongoDB thành công!")
     db = client[os.getenv('DATABASE_NAME')]
+
+    # Client báo cáo: pool riêng, ưu tiên đọc từ secondary với độ trễ giới hạn
+    if READ_ROUTING:
+        staleness = {}
+        if REPORT_READ_PREFERENCE != 'primary':
+            staleness['maxStalenessSeconds'] = REPORT_MAX_STALENESS_S
+        report_client = MongoClient(
+            MONGODB_REPORT_URI,
+            event_listeners=[db_monitor],
+            readPreference=REPORT_READ_PREFERENCE,
+            maxPoolSize=REPORT_MAX_POOL_SIZE,
+            serverSelectionTimeoutMS=REPORT_TIMEOUT_MS,
+            socketTimeoutMS=REPORT_TIMEOUT_MS,
+            **staleness
+        )
+        report_client.admin.command('ping')
+        print(f"✅ Kết nối MongoDB cho báo cáo ({REPORT_READ_PREFERENCE}) thành công!")
+        report_db = report_client[os.getenv('DATABASE_NAME')]
+    else:
+        report_client = client
+        report_db = db
 except Exception as e:
     print(f"❌ Lỗi kết nối MongoDB: {e}")
     raise
 
 # Collections
 thuchi_collections = {}  # Dictionary to store user-specific collections
+report_collections = {}  # Collection chỉ đọc dùng cho báo cáo
 
 def get_user_collection(user_id):
     """Get or create a collection for a specific user."""
@@ -63,8 +271,278 @@ def get_user_collection(user_id):
         print(f"❌ Lỗi khi tạo collection cho user {user_id}: {e}")
         raise
 
+def get_report_collection(user_id):
+    """Lấy collection của user để đọc báo cáo (có thể đọc từ secondary)."""
+    collection_name = f'thuchi_{user_id}'
+    if collection_name not in report_collections:
+        report_collections[collection_name] = report_db[collection_name]
+    return report_collections[collection_name]
+
 # Keywords collection
 tu_khoa_collection = db['tu_khoa']
+tu_khoa_report_collection = report_db['tu_khoa']
+
+# Ngân sách theo danh mục
+ngan_sach_collection = db['ngan_sach']  # {_id: user_id, han_muc: {danh_muc: số tiền}}
+# {_id: 'user_id:month', user_id, month, tong: {...}, ngay: {dd: {...}}, so_du, han_muc: {...}, dong: bool}
+tong_danh_muc_collection = db['tong_danh_muc']
+tong_danh_muc_collection.create_index([('user_id', 1), ('month', 1)])
+tong_danh_muc_report_collection = report_db['tong_danh_muc']
+
+def category_total_id(user_id, month: str) -> str:
+    return f'{user_id}:{month}'
+
+def compute_category_totals(user_id, month: str) -> dict:
+    """Tính tổng chi tiêu theo danh mục của một tháng từ các bản ghi đã lưu."""
+    chi_tieu = get_user_collection(user_id).aggregate([
+        {'$match': {'user_id': user_id, 'month': month, 'so_tien': {'$lt': 0}}},
+        {'$group': {'_id': '$danh_muc', 'tong': {'$sum': '$so_tien'}}}
+    ])
+    tong = {}
+    for ct in chi_tieu:
+        danh_muc = ct['_id'] or 'Khác'
+        tong[danh_muc] = tong.get(danh_muc, 0) - ct['tong']
+    return tong
+
+def compute_daily_totals(user_id, month: str) -> dict:
+    """Tính tổng chi tiêu theo ngày ('dd'), giờ ('HH') và danh mục của một tháng."""
+    chi_tieu = get_user_collection(user_id).aggregate([
+        {'$match': {'user_id': user_id, 'month': month, 'so_tien': {'$lt': 0}}},
+        {'$group': {
+            '_id': {
+                'ngay': {'$dateToString': {'format': '%d', 'date': '$created_at'}},
+                'gio': {'$dateToString': {'format': '%H', 'date': '$created_at'}},
+                'danh_muc': '$danh_muc'
+            },
+            'tong': {'$sum': '$so_tien'}
+        }}
+    ])
+    ngay = {}
+    for ct in chi_tieu:
+        theo_danh_muc = ngay.setdefault(ct['_id']['ngay'], {}).setdefault(ct['_id']['gio'], {})
+        danh_muc = ct['_id'].get('danh_muc') or 'Khác'
+        theo_danh_muc[danh_muc] = theo_danh_muc.get(danh_muc, 0) - ct['tong']
+    return ngay
+
+def sync_category_totals(user_id, month: str):
+    """Tạo tổng theo danh mục của tháng nếu chưa có, chép hạn mức và số dư hiện tại của người dùng vào."""
+    key = category_total_id(user_id, month)
+    budgets = (ngan_sach_collection.find_one({'_id': user_id}) or {}).get('han_muc', {})
+    update = {'$set': {'han_muc': budgets}}
+    balance = get_user_collection(user_id).find_one({'user_id': user_id, 'month': month})
+    if balance:
+        update['$set']['so_du'] = balance['so_tien']
+    if not tong_danh_muc_collection.find_one({'_id': key}, {'_id': 1}):
+        # Tháng chưa có tổng (dữ liệu cũ), tính lại từ các chi tiêu đã ghi
+        update['$setOnInsert'] = {
+            'user_id': user_id,
+            'month': month,
+            'tong': compute_category_totals(user_id, month),
+            'ngay': compute_daily_totals(user_id, month)
+        }
+    tong_danh_muc_collection.update_one({'_id': key}, update, upsert=True)
+
+def increment_category_totals(user_id, month: str, records: list, so_du: int) -> dict:
+    """Cộng các chi tiêu (đã được ghi vào sổ) vào tổng theo danh mục và theo giờ, ghi lại số dư mới.
+
+    Thường chỉ dùng một lệnh atomic và trả về document sau khi cộng. Nếu tháng
+    chưa có bản tổng hợp thì tạo từ sổ chi tiêu, vốn đã gồm các chi tiêu này.
+    """
+    inc = {}
+    for record in records:
+        for field in (f'tong.{record["danh_muc"]}', f'ngay.{record["created_at"]:%d.%H}.{record["danh_muc"]}'):
+            inc[field] = inc.get(field, 0) - record['so_tien']
+    key = category_total_id(user_id, month)
+    totals = tong_danh_muc_collection.find_one_and_update(
+        {'_id': key},
+        {'$inc': inc, '$set': {'so_du': so_du}},
+        return_document=ReturnDocument.AFTER
+    )
+    if totals is None:
+        # Tháng đang dở khi triển khai: tạo đủ tổng và hạn mức thay vì chỉ chứa chi tiêu này
+        sync_category_totals(user_id, month)
+        totals = tong_danh_muc_collection.find_one_and_update(
+            {'_id': key},
+            {'$set': {'so_du': so_du}},
+            return_document=ReturnDocument.AFTER
+        )
+    return totals
+
+def budget_alert(danh_muc: str, before: int, after: int, limit: int) -> str:
+    """Cảnh báo khi tổng chi của danh mục vừa vượt qua 80% hoặc 100% hạn mức."""
+    if not limit:
+        return ''
+    emoji = CATEGORY_EMOJIS.get(danh_muc, '📌')
+    if before < limit <= after:
+        return f'🚨 {emoji} {danh_muc} đã vượt ngân sách tháng: {after:,}đ / {limit:,}đ'
+    if before < limit * 0.8 <= after:
+        return f'⚠️ {emoji} {danh_muc} đã dùng {after / limit * 100:.0f}% ngân sách tháng: {after:,}đ / {limit:,}đ'
+    return ''
+
+# Ghi chi tiêu theo lô (group commit)
+GROUP_COMMIT = os.getenv('GROUP_COMMIT', '0') == '1'
+GROUP_COMMIT_WINDOW_MS = float(os.getenv('GROUP_COMMIT_WINDOW_MS', 5))  # Thời gian gom lô tối đa
+GROUP_COMMIT_MAX_BATCH = int(os.getenv('GROUP_COMMIT_MAX_BATCH', 100))  # Số chi tiêu tối đa mỗi lô
+GROUP_COMMIT_W = os.getenv('GROUP_COMMIT_W', '1')  # Write concern: số node hoặc 'majority'
+GROUP_COMMIT_JOURNAL = os.getenv('GROUP_COMMIT_JOURNAL', '0') == '1'  # Chờ ghi journal trước khi xác nhận
+
+class ExpenseWriteError(Exception):
+    """Lỗi khi ghi chi tiêu. saved=True nghĩa là chi tiêu đã được ghi, chỉ bước cập nhật sau đó bị lỗi."""
+
+    def __init__(self, message: str, saved: bool):
+        super().__init__(message)
+        self.saved = saved
+
+class ExpenseWriteQueue:
+    """Gom các chi tiêu thành lô, ghi mỗi collection bằng một bulk_write.
+
+    Người dùng chỉ nhận xác nhận sau khi lô chứa chi tiêu của họ đã được ghi
+    với write concern đã cấu hình, nên số dư trả về luôn là số dư sau khi ghi.
+    """
+
+    def __init__(self, window_ms: float, max_batch: int, write_concern: WriteConcern):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.write_concern = write_concern
+        self.pending = []  # (collection, month, record, future)
+        self.flush_lock = asyncio.Lock()
+        self.timer = None
+        self.tasks = set()
+
+    async def submit(self, collection, month: str, record: dict):
+        """Đưa một chi tiêu vào hàng đợi, trả về (số dư, cảnh báo ngân sách) sau khi lô được ghi."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((collection, month, record, future))
+        if len(self.pending) >= self.max_batch:
+            self.start_task(self.flush())
+        elif self.timer is None:
+            self.timer = self.start_task(self.flush_after(self.window))
+        return await future
+
+    def start_task(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def flush_after(self, delay: float):
+        await asyncio.sleep(delay)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Ghi toàn bộ chi tiêu đang chờ."""
+        # Task này được tạo từ update đầu tiên của lô, không tính round trip cho update đó
+        current_update_stats.set(None)
+        async with self.flush_lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                results = await asyncio.to_thread(self.write_batch, batch)
+            except Exception as e:
+                logger.error(f'❌ Lỗi khi ghi lô {len(batch)} chi tiêu: {e}')
+                results = [ExpenseWriteError(str(e), saved=False)] * len(batch)
+            for (*_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def write_batch(self, batch) -> list:
+        """Ghi một lô và tính số dư, cảnh báo ngân sách sau từng chi tiêu theo thứ tự nhận được.
+
+        Lỗi chỉ ảnh hưởng đến các chi tiêu của collection (hoặc người dùng) bị lỗi:
+        phần tử tương ứng trong kết quả là một ExpenseWriteError.
+        """
+        groups = {}  # collection name -> (collection, [(index, month, record)])
+        for i, (collection, month, record, _) in enumerate(batch):
+            groups.setdefault(collection.name, (collection, []))[1].append((i, month, record))
+
+        results = [None] * len(batch)
+        for collection, entries in groups.values():
+            # Gộp các khoản trừ số dư của cùng một người dùng trong cùng tháng
+            increments = {}
+            requests = []
+            for _, month, record in entries:
+                requests.append(InsertOne(record))
+                key = (record['user_id'], month)
+                increments[key] = increments.get(key, 0) + record['so_tien']
+            requests += [
+                UpdateOne({'user_id': user_id, 'month': month}, {'$inc': {'so_tien': so_tien}})
+                for (user_id, month), so_tien in increments.items()
+            ]
+            try:
+                collection.with_options(write_concern=self.write_concern).bulk_write(requests, ordered=True)
+            except Exception as e:
+                logger.error(f'❌ Lỗi khi ghi {len(entries)} chi tiêu vào {collection.name}: {e}')
+                for i, _, _ in entries:
+                    results[i] = ExpenseWriteError(str(e), saved=False)
+                continue
+
+            for user_id, month in increments:
+                user_entries = [
+                    (i, record) for i, entry_month, record in entries
+                    if record['user_id'] == user_id and entry_month == month
+                ]
+                try:
+                    balance = collection.find_one({'user_id': user_id, 'month': month})['so_tien']
+                    totals = increment_category_totals(user_id, month, [record for _, record in user_entries], balance)
+                except Exception as e:
+                    # Chi tiêu đã được ghi, không để người dùng nhập lại
+                    logger.error(f'❌ Lỗi khi cập nhật tổng hợp của user {user_id}: {e}')
+                    for i, _ in user_entries:
+                        results[i] = ExpenseWriteError(str(e), saved=True)
+                    continue
+                tong = dict(totals['tong'])
+                han_muc = totals.get('han_muc', {})
+
+                # Tính ngược từ số dư và tổng cuối cùng để có kết quả sau mỗi chi tiêu
+                for i, record in reversed(user_entries):
+                    danh_muc = record['danh_muc']
+                    after = tong[danh_muc]
+                    tong[danh_muc] += record['so_tien']
+                    results[i] = (balance, budget_alert(danh_muc, tong[danh_muc], after, han_muc.get(danh_muc)))
+                    balance -= record['so_tien']
+        return results
+
+    async def close(self):
+        """Ghi nốt các chi tiêu còn trong hàng đợi khi tắt bot."""
+        await self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+expense_queue = None
+if GROUP_COMMIT:
+    expense_queue = ExpenseWriteQueue(
+        GROUP_COMMIT_WINDOW_MS,
+        GROUP_COMMIT_MAX_BATCH,
+        WriteConcern(
+            w=int(GROUP_COMMIT_W) if GROUP_COMMIT_W.isdigit() else GROUP_COMMIT_W,
+            j=GROUP_COMMIT_JOURNAL
+        )
+    )
+
+def load_keywords() -> list:
+    """Lấy toàn bộ từ khóa dạng (từ khóa, danh mục)."""
+    # Sắp xếp giảm dần để ưu tiên từ dài hơn
+    return [(k['tu_khoa'], k['danh_muc']) for k in tu_khoa_collection.find().sort('tu_khoa', -1)]
+
+def classify_expense(description: str, keywords: list) -> str:
+    """Xác định danh mục từ danh sách từ khóa đã tải sẵn (xem load_keywords)."""
+    description = description.lower()
+    
+    # Ưu tiên từ khóa khớp chính xác, sau đó đến từ khóa là substring
+    for tu_khoa, danh_muc in keywords:
+        if tu_khoa == description:
+            return danh_muc
+    for tu_khoa, danh_muc in keywords:
+        if tu_khoa in description:
+            return danh_muc
+    
+    return 'Khác'
 
 def get_expense_category(description: str) -> str:
     """Xác định danh mục chi tiêu dựa trên mô tả."""
@@ -76,12 +554,94 @@ def get_expense_category(description: str) -> str:
         return keyword_doc['danh_muc']
         
     # Nếu không tìm thấy khớp chính xác, tìm từ khóa là substring
-    all_keywords = list(tu_khoa_collection.find().sort('tu_khoa', -1))  # Sắp xếp giảm dần để ưu tiên từ dài hơn
-    for keyword_doc in all_keywords:
-        if keyword_doc['tu_khoa'] in description:
-            return keyword_doc['danh_muc']
-    
-    return 'Khác'
+    return classify_expense(description, load_keywords())
+
+def parse_amount(amount_str: str) -> int:
+    """Chuyển số tiền dạng 50k, 2tr hoặc 50000 thành số."""
+    amount_str = amount_str.lower()
+    if amount_str.endswith('k'):
+        return int(amount_str[:-1]) * 1000
+    if amount_str.endswith('tr'):
+        return int(amount_str[:-2]) * 1000000
+    return int(amount_str)
+
+# Giới hạn các báo cáo tốn kém
+REPORT_COSTS = {  # Chi phí (token) của từng loại báo cáo
+    'xem_tien': 1,
+    'tim': 1,
+    'xem_thang': 2,
+    'tong_hop': 3,
+    'xu_huong': 4,
+    'phan_tich': 5  # Quét cả tháng và vẽ biểu đồ 300 dpi
+}
+# Các nút chạy báo cáo qua run_report (được trả lời trong run_report)
+REPORT_BUTTONS = {'xem_tien', 'phan_tich', 'tong_hop', 'xu_huong'}
+
+def report_button(data: str):
+    """Tên báo cáo của một nút bấm nếu nút đó chạy qua run_report, ngược lại None."""
+    if data in REPORT_BUTTONS:
+        return data
+    if data.startswith('tim_trang_'):
+        return 'tim'
+    return None
+
+REPORT_BUCKET_CAPACITY = float(os.getenv('REPORT_BUCKET_CAPACITY', 10))  # Số token tối đa mỗi người dùng
+REPORT_BUCKET_REFILL = float(os.getenv('REPORT_BUCKET_REFILL', 0.2))  # Số token hồi lại mỗi giây
+
+class TokenBucket:
+    """Token bucket theo từng người dùng, mỗi báo cáo tiêu tốn số token bằng chi phí của nó."""
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.buckets = {}  # user_id -> (số token, thời điểm cập nhật)
+
+    def consume(self, user_id, cost: float) -> bool:
+        now = time.monotonic()
+        tokens, last = self.buckets.get(user_id, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - last) * self.refill_rate)
+        if tokens < cost:
+            self.buckets[user_id] = (tokens, now)
+            return False
+        self.buckets[user_id] = (tokens - cost, now)
+        return True
+
+report_limiter = TokenBucket(REPORT_BUCKET_CAPACITY, REPORT_BUCKET_REFILL)
+reports_in_flight = set()  # (user_id, báo cáo, khóa) của các báo cáo đang chạy
+
+async def run_report(update: Update, report: str, key, report_fn) -> bool:
+    """Chạy một báo cáo, bỏ qua yêu cầu trùng đang chạy và giới hạn chi phí theo người dùng.
+
+    Với callback query, hàm này tự trả lời query. Trả về True nếu báo cáo đã được chạy.
+    """
+    user_id = update.effective_user.id
+    flight_key = (user_id, report, key)
+
+    busy = flight_key in reports_in_flight or not report_limiter.consume(user_id, REPORT_COSTS[report])
+    if busy:
+        if update.callback_query:
+            await update.callback_query.answer('⏳ Đang xử lý, vui lòng chờ trong giây lát...')
+        else:
+            await update.message.reply_text('⏳ Đang xử lý, vui lòng chờ trong giây lát...')
+        return False
+
+    if update.callback_query:
+        await update.callback_query.answer()
+    reports_in_flight.add(flight_key)
+    try:
+        await report_fn()
+    finally:
+        reports_in_flight.discard(flight_key)
+    return True
+
+def normalize_text(text: str) -> str:
+    """Chuyển về chữ thường và bỏ dấu tiếng Việt (ví dụ: 'Đi chợ' -> 'di cho')."""
+    text = unicodedata.normalize('NFD', text.lower()).replace('đ', 'd')
+    return ''.join(c for c in text if unicodedata.category(c) != 'Mn')
+
+def search_tokens(text: str) -> list:
+    """Tách mô tả thành các từ đã bỏ dấu để lưu vào chỉ mục tìm kiếm."""
+    return sorted(set(re.findall(r'\w+', normalize_text(text))))
 
 def is_admin(user_id: int) -> bool:
     """Kiểm tra xem user có phải là admin không."""
@@ -104,6 +664,14 @@ async def show_menu(update: Update):
             InlineKeyboardButton("Tổng hợp chi tiêu", callback_data='tong_hop'),
             InlineKeyboardButton("Xem chi tiêu theo tháng", callback_data='xem_thang')
         ],
+        [
+            InlineKeyboardButton("🔍 Tìm chi tiêu", callback_data='tim_kiem'),
+            InlineKeyboardButton("🎯 Ngân sách", callback_data='ngan_sach')
+        ],
+        [
+            InlineKeyboardButton("📈 Xu hướng chi tiêu", callback_data='xu_huong'),
+            InlineKeyboardButton("🌙 Bản tin tự động", callback_data='ban_tin')
+        ],
         [
             InlineKeyboardButton("☕️ Buy me a coffee", callback_data='donate')
         ]
@@ -144,6 +712,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("Tổng hợp chi tiêu", callback_data='tong_hop'),
             InlineKeyboardButton("Xem chi tiêu theo tháng", callback_data='xem_thang')
         ],
+        [
+            InlineKeyboardButton("🔍 Tìm chi tiêu", callback_data='tim_kiem'),
+            InlineKeyboardButton("🎯 Ngân sách", callback_data='ngan_sach')
+        ],
+        [
+            InlineKeyboardButton("📈 Xu hướng chi tiêu", callback_data='xu_huong'),
+            InlineKeyboardButton("🌙 Bản tin tự động", callback_data='ban_tin')
+        ],
         [
             InlineKeyboardButton("☕️ Buy me a coffee", callback_data='donate')
         ]
@@ -174,8 +750,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button presses."""
     query = update.callback_query
-    await query.answer()
     user_id = update.effective_user.id
+    current_month = datetime.now().strftime('%Y-%m')
+
+    # Các nút báo cáo được trả lời trong run_report để có thể báo "đang xử lý"
+    if report_button(query.data) is None:
+        await query.answer()
 
     if query.data == 'donate':
         # Gửi ảnh QR code và lời cảm ơn
@@ -207,14 +787,46 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'Ví dụ: them_tien 500000'
         )
     elif query.data == 'xem_tien':
-        await xem_so_du(update, context)
-        await show_menu(update)
+        if await run_report(update, 'xem_tien', current_month, lambda: xem_so_du(update, context)):
+            await show_menu(update)
     elif query.data == 'phan_tich':
-        await phan_tich_chi_tieu(update, context)
-        await show_menu(update)
+        if await run_report(update, 'phan_tich', current_month, lambda: phan_tich_chi_tieu(update, context)):
+            await show_menu(update)
     elif query.data == 'tong_hop':
-        await tong_hop_chi_tieu(update, context)
+        if await run_report(update, 'tong_hop', current_month, lambda: tong_hop_chi_tieu(update, context)):
+            await show_menu(update)
+    elif query.data == 'xu_huong':
+        # Mặc định xem 12 tháng gần nhất
+        now = datetime.now()
+        start_month = f'{now.year - 1}-{now.month + 1:02d}' if now.month < 12 else f'{now.year}-01'
+        end_month = now.strftime('%Y-%m')
+        if await run_report(update, 'xu_huong', (start_month, end_month),
+                            lambda: xu_huong_chi_tieu(update, context, start_month, end_month)):
+            await query.message.reply_text(
+                'Xem khoảng thời gian khác theo định dạng:\n'
+                'xu_huong [yyyy] hoặc xu_huong [mm/yyyy-mm/yyyy]\n'
+                'Ví dụ: xu_huong 2024, xu_huong 06/2023-05/2024'
+            )
+            await show_menu(update)
+    elif query.data == 'ban_tin':
+        await xem_ban_tin(update, context)
+        await show_menu(update)
+    elif query.data == 'ngan_sach':
+        await xem_ngan_sach(update, context)
         await show_menu(update)
+    elif query.data == 'tim_kiem':
+        await query.message.reply_text(
+            'Vui lòng nhập từ khóa cần tìm theo định dạng:\n'
+            'tim [từ khóa] [thời gian]\n\n'
+            'Thời gian có thể bỏ trống hoặc là yyyy, mm/yyyy, dd/mm/yyyy-dd/mm/yyyy\n'
+            'Ví dụ: tim grab 2024, tim cà phê 03/2024'
+        )
+    elif query.data.startswith('tim_trang_'):
+        trang = int(query.data[len('tim_trang_'):])
+        await run_report(
+            update, 'tim', (context.user_data.get('tim_kiem'), trang),
+            lambda: tim_chi_tieu(update, context, trang)
+        )
     elif query.data == 'xem_thang':
         await query.message.reply_text(
             'Vui lòng nhập tháng năm cần xem theo định dạng:\n'
@@ -371,12 +983,90 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             thang, nam = thang_nam.split('/')
             thang = thang.zfill(2)
             month_str = f"{nam}-{thang}"
-            await xem_chi_tieu_theo_thang(update, context, month_str)
-            await show_menu(update)
+            if await run_report(update, 'xem_thang', month_str,
+                                lambda: xem_chi_tieu_theo_thang(update, context, month_str)):
+                await show_menu(update)
         except (IndexError, ValueError):
             await update.message.reply_text('Vui lòng nhập đúng định dạng: xem_thang mm/yyyy (ví dụ: xem_thang 03/2024)')
             await show_menu(update)
     
+    elif text.startswith('xu_huong'):
+        try:
+            start_month, end_month = parse_month_range(text[len('xu_huong'):].strip())
+        except ValueError:
+            await update.message.reply_text(
+                'Vui lòng nhập đúng định dạng: xu_huong [yyyy] hoặc xu_huong [mm/yyyy-mm/yyyy]\n'
+                f'Khoảng thời gian tối đa {TREND_MAX_MONTHS} tháng. Ví dụ: xu_huong 2024, xu_huong 06/2023-05/2024'
+            )
+            await show_menu(update)
+            return
+
+        if await run_report(update, 'xu_huong', (start_month, end_month),
+                            lambda: xu_huong_chi_tieu(update, context, start_month, end_month)):
+            await show_menu(update)
+    
+    elif text == 'ban_tin':
+        await xem_ban_tin(update, context)
+        await show_menu(update)
+    
+    elif text.startswith('ban_tin '):
+        try:
+            # Lấy tham số từ tin nhắn gốc: text đã bị chuyển về chữ thường, làm sai tên múi giờ
+            await dang_ky_ban_tin(update, context, update.message.text.split()[1:])
+        except (IndexError, ValueError, ZoneInfoNotFoundError):
+            await update.message.reply_text(
+                'Vui lòng nhập đúng định dạng: ban_tin [ngay|tuan] [giờ] [múi giờ]\n'
+                'Ví dụ: ban_tin ngay 21, ban_tin tuan 20 Asia/Bangkok, ban_tin tat'
+            )
+        await show_menu(update)
+    
+    elif text == 'ngan_sach':
+        await xem_ngan_sach(update, context)
+        await show_menu(update)
+    
+    elif text.startswith('ngan_sach '):
+        try:
+            parts = text.split()
+            stt_danh_muc = int(parts[1])
+            han_muc = parse_amount(parts[2])
+            if stt_danh_muc < 1 or stt_danh_muc > len(CATEGORIES) or han_muc < 0:
+                raise ValueError
+            await dat_ngan_sach(update, context, CATEGORIES[stt_danh_muc - 1], han_muc)
+            await show_menu(update)
+        except (IndexError, ValueError):
+            await update.message.reply_text(
+                'Vui lòng nhập đúng định dạng: ngan_sach [số thứ tự] [số tiền]\n'
+                'Ví dụ: ngan_sach 1 3tr (nhập 0 để bỏ ngân sách)\n\n'
+                'Danh sách danh mục:\n' +
+                '\n'.join([f'{i+1}. {CATEGORY_EMOJIS[cat]} {cat}' for i, cat in enumerate(CATEGORIES)])
+            )
+            await show_menu(update)
+    
+    elif text.startswith('tim '):
+        try:
+            tu_khoa, tu_ngay, den_ngay = parse_search_query(text.split(' ', 1)[1])
+        except ValueError:
+            await update.message.reply_text(
+                'Vui lòng nhập đúng định dạng: tim [từ khóa] [thời gian]\n'
+                'Ví dụ: tim grab 2024, tim cà phê 03/2024, tim xăng 01/01/2024-31/03/2024'
+            )
+            await show_menu(update)
+            return
+
+        context.user_data['tim_kiem'] = (tu_khoa, tu_ngay, den_ngay)
+        await run_report(
+            update, 'tim', (context.user_data['tim_kiem'], 1),
+            lambda: tim_chi_tieu(update, context, 1)
+        )
+    
+    elif text == 'db_stats':
+        if not is_admin(user_id):
+            await update.message.reply_text('❌ Bạn không có quyền sử dụng chức năng này!')
+            return
+
+        await update.message.reply_text(db_monitor.format_stats())
+        await show_menu(update)
+    
     elif text == 'xoa_du_lieu xac_nhan':
         await xoa_du_lieu(update, context)
         await show_menu(update)
@@ -402,13 +1092,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             description = parts[1].lower()
             
             # Convert amount to number
-            amount = 0
-            if amount_str.endswith('k'):
-                amount = int(amount_str[:-1]) * 1000
-            elif amount_str.endswith('tr'):
-                amount = int(amount_str[:-2]) * 1000000
-            else:
-                amount = int(amount_str)
+            amount = parse_amount(amount_str)
             
             # Get user's collection
             thuchi_collection = get_user_collection(update.effective_user.id)
@@ -430,34 +1114,69 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Get category for expense
             category = get_expense_category(description)
             
-            # Insert expense record
-            thuchi_collection.insert_one({
+            record = {
                 'user_id': update.effective_user.id,
                 'month': current_month,
                 'so_tien': -amount,  # Negative for expenses
                 'mo_ta': description,
+                'tim_kiem': search_tokens(description),  # Chỉ mục tìm kiếm không dấu
                 'danh_muc': category,
                 'created_at': datetime.now()
-            })
-            
-            # Update balance
-            thuchi_collection.update_one(
-                {'user_id': update.effective_user.id, 'month': current_month},
-                {'$inc': {'so_tien': -amount}}
-            )
+            }
             
-            # Get updated balance
-            updated = thuchi_collection.find_one({
-                'user_id': update.effective_user.id,
-                'month': current_month
-            })
+            try:
+                if expense_queue:
+                    # Ghi theo lô cùng các chi tiêu khác, chờ đến khi lô được ghi xong
+                    so_du, canh_bao = await expense_queue.submit(thuchi_collection, current_month, record)
+                else:
+                    # Insert expense record
+                    try:
+                        thuchi_collection.insert_one(record)
+                    except Exception as e:
+                        raise ExpenseWriteError(str(e), saved=False) from e
+
+                    try:
+                        # Update balance
+                        thuchi_collection.update_one(
+                            {'user_id': update.effective_user.id, 'month': current_month},
+                            {'$inc': {'so_tien': -amount}}
+                        )
+
+                        # Get updated balance
+                        updated = thuchi_collection.find_one({
+                            'user_id': update.effective_user.id,
+                            'month': current_month
+                        })
+                        so_du = updated['so_tien']
+
+                        # Cộng vào tổng theo danh mục và kiểm tra ngân sách
+                        totals = increment_category_totals(update.effective_user.id, current_month, [record], so_du)
+                        after = totals['tong'][category]
+                        canh_bao = budget_alert(category, after - amount, after, totals.get('han_muc', {}).get(category))
+                    except Exception as e:
+                        raise ExpenseWriteError(str(e), saved=True) from e
+            except ExpenseWriteError as e:
+                logger.error(f'❌ Lỗi khi ghi chi tiêu của user {update.effective_user.id}: {e}')
+                if e.saved:
+                    await update.message.reply_text(
+                        f'⚠️ Đã ghi nhận chi tiêu {amount:,}đ ({description}) nhưng chưa cập nhật được số dư, '
+                        'vui lòng kiểm tra lại bằng "Xem số tiền còn lại" và không nhập lại khoản này.'
+                    )
+                else:
+                    await update.message.reply_text(
+                        '❌ Không thể ghi chi tiêu do lỗi kết nối cơ sở dữ liệu. '
+                        'Vui lòng kiểm tra số dư trước khi nhập lại.'
+                    )
+                return
             
             # Send confirmation message
             message = f'✅ Đã ghi nhận chi tiêu:\n\n'
             message += f'💰 Số tiền: {amount:,}đ\n'
             message += f'📝 Mô tả: {description}\n'
             message += f'🏷️ Danh mục: {CATEGORY_EMOJIS.get(category, "📌")} {category}\n'
-            message += f'💎 Số dư còn lại: {updated["so_tien"]:,}đ'
+            message += f'💎 Số dư còn lại: {so_du:,}đ'
+            if canh_bao:
+                message += f'\n\n{canh_bao}'
             
             await update.message.reply_text(message)
             await show_menu(update)
@@ -491,6 +1210,9 @@ async def nhap_tien_ban_dau(update: Update, context: ContextTypes.DEFAULT_TYPE,
         'created_at': datetime.now()
     })
     
+    # Áp dụng ngân sách của người dùng cho tháng mới
+    sync_category_totals(user_id, current_month)
+    
     await update.message.reply_text(f'✅ Đã nhập số tiền ban đầu: {so_tien:,}đ')
 
 async def them_tien(update: Update, context: ContextTypes.DEFAULT_TYPE, so_tien: int):
@@ -516,6 +1238,10 @@ async def them_tien(update: Update, context: ContextTypes.DEFAULT_TYPE, so_tien:
         {'user_id': user_id, 'month': current_month},
         {'$inc': {'so_tien': so_tien}}
     )
+    tong_danh_muc_collection.update_one(
+        {'_id': category_total_id(user_id, current_month), 'so_du': {'$exists': True}},
+        {'$inc': {'so_du': so_tien}}
+    )
     
     await update.message.reply_text(f'✅ Đã thêm {so_tien:,}đ vào số dư')
 
@@ -567,7 +1293,7 @@ async def xem_chi_tieu_theo_thang(update: Update, context: ContextTypes.DEFAULT_
     user_id = update.effective_user.id
     
     # Get user's collection
-    thuchi_collection = get_user_collection(user_id)
+    thuchi_collection = get_report_collection(user_id)
     
     # Get expenses for the month
     chi_tieu = list(thuchi_collection.find({
@@ -618,7 +1344,7 @@ async def phan_tich_chi_tieu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     current_month = datetime.now().strftime('%Y-%m')
     
     # Get user's collection
-    thuchi_collection = get_user_collection(user_id)
+    thuchi_collection = get_report_collection(user_id)
     
     chi_tieu = list(thuchi_collection.find({
         'user_id': user_id,
@@ -698,7 +1424,7 @@ async def tong_hop_chi_tieu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     current_month = datetime.now().strftime('%Y-%m')
     
     # Get user's collection
-    thuchi_collection = get_user_collection(user_id)
+    thuchi_collection = get_report_collection(user_id)
     
     # Get all expenses for the month
     chi_tieu = list(thuchi_collection.find({
@@ -766,6 +1492,304 @@ async def tong_hop_chi_tieu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.callback_query.message.reply_text(message)
 
+async def dat_ngan_sach(update: Update, context: ContextTypes.DEFAULT_TYPE, danh_muc: str, han_muc: int):
+    """Đặt ngân sách hàng tháng cho một danh mục."""
+    user_id = update.effective_user.id
+    current_month = datetime.now().strftime('%Y-%m')
+    
+    if han_muc > 0:
+        ngan_sach_collection.update_one({'_id': user_id}, {'$set': {f'han_muc.{danh_muc}': han_muc}}, upsert=True)
+    else:
+        ngan_sach_collection.update_one({'_id': user_id}, {'$unset': {f'han_muc.{danh_muc}': ''}})
+    
+    # Áp dụng ngay cho tháng hiện tại
+    sync_category_totals(user_id, current_month)
+    
+    emoji = CATEGORY_EMOJIS.get(danh_muc, '📌')
+    if han_muc > 0:
+        await update.message.reply_text(f'✅ Đã đặt ngân sách {emoji} {danh_muc}: {han_muc:,}đ/tháng')
+    else:
+        await update.message.reply_text(f'✅ Đã bỏ ngân sách {emoji} {danh_muc}')
+
+async def xem_ngan_sach(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xem ngân sách và mức sử dụng trong tháng."""
+    user_id = update.effective_user.id
+    current_month = datetime.now().strftime('%Y-%m')
+    reply = update.message or update.callback_query.message
+    
+    totals = tong_danh_muc_collection.find_one({'_id': category_total_id(user_id, current_month)}) or {}
+    han_muc = totals.get('han_muc', {})
+    
+    if not han_muc:
+        await reply.reply_text(
+            '🎯 Bạn chưa đặt ngân sách nào!\n\n'
+            'Đặt ngân sách theo định dạng: ngan_sach [số thứ tự] [số tiền]\n'
+            'Ví dụ: ngan_sach 1 3tr\n\n'
+            'Danh sách danh mục:\n' +
+            '\n'.join([f'{i+1}. {CATEGORY_EMOJIS[cat]} {cat}' for i, cat in enumerate(CATEGORIES)])
+        )
+        return
+    
+    message = f'🎯 Ngân sách tháng {current_month}:\n\n'
+    for danh_muc in CATEGORIES:
+        if danh_muc not in han_muc:
+            continue
+        da_chi = totals.get('tong', {}).get(danh_muc, 0)
+        phan_tram = da_chi / han_muc[danh_muc] * 100
+        trang_thai = '🚨' if phan_tram >= 100 else '⚠️' if phan_tram >= 80 else '✅'
+        message += (
+            f'{trang_thai} {CATEGORY_EMOJIS[danh_muc]} {danh_muc}: '
+            f'{da_chi:,}đ / {han_muc[danh_muc]:,}đ ({phan_tram:.0f}%)\n'
+        )
+    message += '\nĐặt ngân sách: ngan_sach [số thứ tự] [số tiền]'
+    
+    await reply.reply_text(message)
+
+TREND_MAX_MONTHS = 36
+
+def month_range(start_month: str, end_month: str) -> list:
+    """Danh sách các tháng 'YYYY-MM' từ start_month đến end_month (bao gồm cả hai)."""
+    year, month = map(int, start_month.split('-'))
+    months = []
+    while f'{year:04d}-{month:02d}' <= end_month:
+        months.append(f'{year:04d}-{month:02d}')
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+def parse_month_range(text: str):
+    """Chuyển '', 'yyyy' hoặc 'mm/yyyy-mm/yyyy' thành (tháng bắt đầu, tháng kết thúc) dạng 'YYYY-MM'."""
+    if not text:
+        year = datetime.now().year
+        start_month, end_month = f'{year}-01', f'{year}-12'
+    elif re.fullmatch(r'\d{4}', text):
+        start_month, end_month = f'{text}-01', f'{text}-12'
+    else:
+        bat_dau, ket_thuc = text.split('-')
+        start_month = datetime.strptime(bat_dau, '%m/%Y').strftime('%Y-%m')
+        end_month = datetime.strptime(ket_thuc, '%m/%Y').strftime('%Y-%m')
+    if not 0 < len(month_range(start_month, end_month)) <= TREND_MAX_MONTHS:
+        raise ValueError('Khoảng thời gian không hợp lệ')
+    return start_month, end_month
+
+def load_monthly_summaries(user_id, start_month: str, end_month: str) -> dict:
+    """Lấy tổng chi theo danh mục của từng tháng từ tong_danh_muc.
+
+    Tháng đã kết thúc được tính lại từ sổ chi tiêu đúng một lần rồi đánh dấu dong=True,
+    sau đó chỉ đọc lại bản tổng hợp. Tháng hiện tại dùng tổng được cập nhật khi ghi chi tiêu.
+    """
+    current_month = datetime.now().strftime('%Y-%m')
+    summaries = {
+        doc['month']: doc.get('tong', {})
+        for doc in tong_danh_muc_report_collection.find(
+            {'user_id': user_id, 'month': {'$gte': start_month, '$lte': end_month}},
+            {'month': 1, 'tong': 1, 'dong': 1}
+        )
+        if doc['month'] >= current_month or doc.get('dong')
+    }
+    for month in month_range(start_month, end_month):
+        if month in summaries or month > current_month:
+            continue
+        tong = compute_category_totals(user_id, month)
+        update = {'$setOnInsert': {'user_id': user_id, 'month': month}}
+        if month < current_month:
+            update['$set'] = {'tong': tong, 'dong': True}
+        else:
+            update['$setOnInsert']['tong'] = tong
+        tong_danh_muc_collection.update_one({'_id': category_total_id(user_id, month)}, update, upsert=True)
+        summaries[month] = tong
+    return summaries
+
+async def xu_huong_chi_tieu(update: Update, context: ContextTypes.DEFAULT_TYPE, start_month: str, end_month: str):
+    """Xem xu hướng chi tiêu theo tháng và theo danh mục trong một khoảng thời gian."""
+    user_id = update.effective_user.id
+    reply = update.message or update.callback_query.message
+    current_month = datetime.now().strftime('%Y-%m')
+    
+    months = [m for m in month_range(start_month, end_month) if m <= current_month]
+    summaries = load_monthly_summaries(user_id, start_month, end_month)
+    tong_theo_thang = {m: sum(summaries.get(m, {}).values()) for m in months}
+    tong_chi_tieu = sum(tong_theo_thang.values())
+    
+    def nhan_thang(month):
+        return f'{month[5:]}/{month[:4]}'
+    
+    khoang_thoi_gian = f'{nhan_thang(start_month)} - {nhan_thang(end_month)}'
+    if not tong_chi_tieu:
+        await reply.reply_text(f'📈 Chưa có chi tiêu nào trong khoảng {khoang_thoi_gian}!')
+        return
+    
+    tong_theo_danh_muc = {}
+    for month in months:
+        for danh_muc, so_tien in summaries.get(month, {}).items():
+            tong_theo_danh_muc[danh_muc] = tong_theo_danh_muc.get(danh_muc, 0) + so_tien
+    
+    message = f'📈 Xu hướng chi tiêu {khoang_thoi_gian}:\n\n'
+    message += f'💵 Tổng chi tiêu: {tong_chi_tieu:,}đ\n'
+    message += f'📊 Trung bình: {tong_chi_tieu // len(months):,}đ/tháng\n\n'
+    message += '📅 Theo tháng:\n'
+    truoc = None
+    for month in months:
+        message += f'  • {nhan_thang(month)}: {tong_theo_thang[month]:,}đ'
+        if truoc:
+            thay_doi = (tong_theo_thang[month] - truoc) / truoc * 100
+            message += f' ({"📈" if thay_doi >= 0 else "📉"} {thay_doi:+.1f}%)'
+        message += '\n'
+        truoc = tong_theo_thang[month]
+    
+    message += '\n📝 Theo danh mục:\n'
+    for danh_muc, so_tien in sorted(tong_theo_danh_muc.items(), key=lambda x: x[1], reverse=True):
+        if so_tien:
+            emoji = CATEGORY_EMOJIS.get(danh_muc, '📌')
+            message += f'{emoji} {danh_muc}: {so_tien:,}đ ({so_tien / tong_chi_tieu * 100:.1f}%)\n'
+    
+    # Biểu đồ cột chồng theo danh mục
+    plt.figure(figsize=(12, 7))
+    plt.clf()
+    colors = ['#FF9999', '#66B2FF', '#99FF99', '#FFCC99', '#FF99CC', '#99FFCC', '#FFB366', '#99CCE6', '#FFB3B3']
+    labels = [nhan_thang(month) for month in months]
+    day = [0] * len(months)
+    for i, danh_muc in enumerate(CATEGORIES):
+        values = [summaries.get(month, {}).get(danh_muc, 0) for month in months]
+        if any(values):
+            plt.bar(labels, values, bottom=day, color=colors[i % len(colors)], label=danh_muc)
+            day = [d + v for d, v in zip(day, values)]
+    plt.xticks(rotation=45)
+    plt.ylabel('Số tiền (đ)')
+    plt.legend(loc='upper left', bbox_to_anchor=(1, 1))
+    plt.title(f'Xu hướng chi tiêu {khoang_thoi_gian}')
+    
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', bbox_inches='tight', dpi=150)
+    buf.seek(0)
+    plt.close()
+    
+    await reply.reply_text(message)
+    await reply.reply_photo(buf)
+
+SEARCH_PAGE_SIZE = 10
+search_ready_collections = set()  # Collection đã có chỉ mục tìm kiếm (bộ nhớ đệm trong process)
+# {_id: 'thuchi_{user_id}', created_at}: lưu trong MongoDB để không bổ sung lại sau khi khởi động lại hoặc ở worker khác
+chi_muc_tim_kiem_collection = db['chi_muc_tim_kiem']
+
+def parse_search_query(query: str):
+    """Tách từ khóa và khoảng thời gian (yyyy, mm/yyyy, dd/mm/yyyy-dd/mm/yyyy) ở cuối câu tìm kiếm."""
+    parts = query.strip().split()
+    tu_ngay = den_ngay = None
+    if len(parts) > 1:
+        thoi_gian = parts[-1]
+        if re.fullmatch(r'\d{4}', thoi_gian):
+            tu_ngay = datetime(int(thoi_gian), 1, 1)
+            den_ngay = datetime(int(thoi_gian) + 1, 1, 1)
+        elif re.fullmatch(r'\d{1,2}/\d{4}', thoi_gian):
+            tu_ngay = datetime.strptime(thoi_gian, '%m/%Y')
+            den_ngay = (tu_ngay + timedelta(days=32)).replace(day=1)
+        elif re.fullmatch(r'\d{1,2}/\d{1,2}/\d{4}-\d{1,2}/\d{1,2}/\d{4}', thoi_gian):
+            bat_dau, ket_thuc = thoi_gian.split('-')
+            tu_ngay = datetime.strptime(bat_dau, '%d/%m/%Y')
+            den_ngay = datetime.strptime(ket_thuc, '%d/%m/%Y') + timedelta(days=1)
+        if tu_ngay:
+            parts = parts[:-1]
+
+    tu_khoa = ' '.join(parts)
+    if not search_tokens(tu_khoa):
+        raise ValueError('Thiếu từ khóa tìm kiếm')
+    return tu_khoa, tu_ngay, den_ngay
+
+def ensure_search_index(user_id) -> bool:
+    """Tạo chỉ mục tìm kiếm và bổ sung trường tim_kiem cho các chi tiêu cũ (chỉ chạy một lần).
+
+    Trả về True nếu collection đã sẵn sàng từ trước.
+    """
+    thuchi_collection = get_user_collection(user_id)
+    if thuchi_collection.name in search_ready_collections:
+        return True
+    if chi_muc_tim_kiem_collection.find_one({'_id': thuchi_collection.name}, {'_id': 1}):
+        search_ready_collections.add(thuchi_collection.name)
+        return True
+
+    thuchi_collection.create_index([('tim_kiem', 1), ('created_at', -1)])
+    requests = [
+        UpdateOne({'_id': ct['_id']}, {'$set': {'tim_kiem': search_tokens(ct['mo_ta'])}})
+        for ct in thuchi_collection.find(
+            {'mo_ta': {'$exists': True}, 'tim_kiem': {'$exists': False}},
+            {'mo_ta': 1}
+        )
+    ]
+    if requests:
+        thuchi_collection.bulk_write(requests, ordered=False)
+    # Chi tiêu mới luôn được ghi kèm tim_kiem nên chỉ cần bổ sung một lần
+    chi_muc_tim_kiem_collection.update_one(
+        {'_id': thuchi_collection.name},
+        {'$setOnInsert': {'created_at': datetime.now()}},
+        upsert=True
+    )
+    search_ready_collections.add(thuchi_collection.name)
+    return False
+
+async def tim_chi_tieu(update: Update, context: ContextTypes.DEFAULT_TYPE, trang: int):
+    """Tìm chi tiêu theo mô tả, không phân biệt dấu."""
+    user_id = update.effective_user.id
+    reply = update.message or update.callback_query.message
+
+    if 'tim_kiem' not in context.user_data:
+        await reply.reply_text('❌ Vui lòng nhập lại lệnh tìm kiếm: tim [từ khóa] [thời gian]')
+        return
+    tu_khoa, tu_ngay, den_ngay = context.user_data['tim_kiem']
+
+    # Lần đầu vừa bổ sung dữ liệu trên primary thì đọc từ primary để không thiếu kết quả
+    if ensure_search_index(user_id):
+        thuchi_collection = get_report_collection(user_id)
+    else:
+        thuchi_collection = get_user_collection(user_id)
+
+    # Mọi từ trong câu tìm kiếm đều phải có trong mô tả
+    dieu_kien = {
+        'user_id': user_id,
+        'so_tien': {'$lt': 0},
+        'tim_kiem': {'$all': search_tokens(tu_khoa)}
+    }
+    if tu_ngay:
+        dieu_kien['created_at'] = {'$gte': tu_ngay, '$lt': den_ngay}
+
+    tong = next(thuchi_collection.aggregate([
+        {'$match': dieu_kien},
+        {'$group': {'_id': None, 'tong': {'$sum': '$so_tien'}, 'so_luong': {'$sum': 1}}}
+    ]), None)
+
+    khoang_thoi_gian = ''
+    if tu_ngay:
+        khoang_thoi_gian = f' ({tu_ngay.strftime("%d/%m/%Y")} - {(den_ngay - timedelta(days=1)).strftime("%d/%m/%Y")})'
+
+    if not tong:
+        await reply.reply_text(f'🔍 Không tìm thấy chi tiêu nào khớp với "{tu_khoa}"{khoang_thoi_gian}!')
+        await show_menu(update)
+        return
+
+    so_trang = (tong['so_luong'] + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    trang = min(max(trang, 1), so_trang)
+    chi_tieu = thuchi_collection.find(dieu_kien).sort('created_at', -1) \
+        .skip((trang - 1) * SEARCH_PAGE_SIZE).limit(SEARCH_PAGE_SIZE)
+
+    message = f'🔍 Kết quả tìm kiếm "{tu_khoa}"{khoang_thoi_gian}:\n\n'
+    message += f'💵 Tổng chi tiêu: {abs(tong["tong"]):,}đ ({tong["so_luong"]} khoản)\n\n'
+    for ct in chi_tieu:
+        emoji = CATEGORY_EMOJIS.get(ct.get('danh_muc', 'Khác'), '📌')
+        thoi_diem = ct['created_at'].strftime('%d/%m/%Y %H:%M')
+        message += f'  • {thoi_diem} - {emoji} {ct["mo_ta"]}: {abs(ct["so_tien"]):,}đ\n'
+    message += f'\n📄 Trang {trang}/{so_trang}'
+
+    # Nút chuyển trang
+    buttons = []
+    if trang > 1:
+        buttons.append(InlineKeyboardButton('⬅️ Trang trước', callback_data=f'tim_trang_{trang - 1}'))
+    if trang < so_trang:
+        buttons.append(InlineKeyboardButton('Trang sau ➡️', callback_data=f'tim_trang_{trang + 1}'))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+
+    await reply.reply_text(message, reply_markup=reply_markup)
+    if not buttons:
+        await show_menu(update)
+
 async def them_tu_khoa(update: Update, context: ContextTypes.DEFAULT_TYPE, tu_khoa: str, danh_muc: str):
     """Thêm từ khóa mới."""
     # Kiểm tra xem từ khóa đã tồn tại chưa
@@ -794,7 +1818,7 @@ async def xem_tu_khoa(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Xem danh sách từ khóa theo danh mục."""
     # Lấy tất cả từ khóa và nhóm theo danh mục
     tu_khoa_theo_danh_muc = {}
-    all_keywords = list(tu_khoa_collection.find().sort('danh_muc'))
+    all_keywords = list(tu_khoa_report_collection.find().sort('danh_muc'))
     
     for keyword in all_keywords:
         danh_muc = keyword['danh_muc']
@@ -861,6 +1885,10 @@ async def xoa_du_lieu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Delete all records
         result = thuchi_collection.delete_many({'user_id': user_id})
+        tong_danh_muc_collection.update_many(
+            {'user_id': user_id},
+            {'$set': {'tong': {}, 'ngay': {}}, '$unset': {'so_du': ''}}
+        )
         
         if result.deleted_count > 0:
             await update.message.reply_text(f'✅ Đã xóa {result.deleted_count} bản ghi chi tiêu của bạn!')
@@ -892,6 +1920,15 @@ async def xoa_du_lieu_theo_ngay(update: Update, context: ContextTypes.DEFAULT_TY
         })
         
         if result.deleted_count > 0:
+            # Tính lại tổng theo danh mục của tháng bị ảnh hưởng
+            month = ngay_obj.strftime('%Y-%m')
+            tong_danh_muc_collection.update_one(
+                {'_id': category_total_id(user_id, month)},
+                {
+                    '$set': {'tong': compute_category_totals(user_id, month)},
+                    '$unset': {f'ngay.{ngay_obj.strftime("%d")}': ''}
+                }
+            )
             await update.message.reply_text(f'✅ Đã xóa {result.deleted_count} bản ghi chi tiêu ngày {ngay}!')
         else:
             await update.message.reply_text(f'❌ Không có dữ liệu nào để xóa cho ngày {ngay}!')
@@ -901,18 +1938,340 @@ async def xoa_du_lieu_theo_ngay(update: Update, context: ContextTypes.DEFAULT_TY
     except Exception as e:
         await update.message.reply_text(f'❌ Lỗi khi xóa dữ liệu: {str(e)}')
 
-def main():
-    """Start the bot."""
+# Bản tin chi tiêu tự động
+DIGEST_ENABLED = os.getenv('DIGEST_ENABLED', '1') == '1'
+DIGEST_DEFAULT_TZ = os.getenv('DIGEST_DEFAULT_TZ', 'Asia/Ho_Chi_Minh')
+DIGEST_INTERVAL_S = int(os.getenv('DIGEST_INTERVAL_S', 300))  # Chu kỳ kiểm tra bản tin đến giờ gửi
+DIGEST_RATE_PER_S = float(os.getenv('DIGEST_RATE_PER_S', 25))  # Telegram giới hạn khoảng 30 tin/giây
+DIGEST_BATCH_SIZE = 1000  # Số người dùng mỗi lần đọc bản tổng hợp
+DIGEST_WEEKDAY = 6  # Bản tin tuần gửi vào Chủ nhật
+
+# {_id: user_id, chat_id, tan_suat: 'ngay'|'tuan', gio, mui_gio, bat, lan_gui_tiep, lan_gui_cuoi, lan_gui_id}
+ban_tin_collection = db['ban_tin']
+ban_tin_collection.create_index([('bat', 1), ('lan_gui_tiep', 1)])
+digest_task = None
+
+def find_timezone(name: str) -> str:
+    """Tên múi giờ chuẩn (ví dụ 'asia/bangkok' -> 'Asia/Bangkok'), không phân biệt hoa thường."""
+    for key in available_timezones():
+        if key.lower() == name.lower():
+            return key
+    raise ZoneInfoNotFoundError(name)
+
+async def dang_ky_ban_tin(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list):
+    """Bật/tắt bản tin hàng ngày hoặc hàng tuần."""
+    user_id = update.effective_user.id
+    args = [args[0].lower()] + args[1:]
+    
+    if args[0] == 'tat':
+        ban_tin_collection.update_one({'_id': user_id}, {'$set': {'bat': False}})
+        await update.message.reply_text('✅ Đã tắt bản tin chi tiêu tự động')
+        return
+    
+    tan_suat = args[0]
+    gio = int(args[1]) if len(args) > 1 else 21
+    mui_gio = find_timezone(args[2]) if len(args) > 2 else DIGEST_DEFAULT_TZ
+    if tan_suat not in ('ngay', 'tuan') or not 0 <= gio <= 23:
+        raise ValueError('Tham số không hợp lệ')
+    
+    setting = {
+        'chat_id': update.effective_chat.id,
+        'tan_suat': tan_suat,
+        'gio': gio,
+        'mui_gio': mui_gio,
+        'bat': True
+    }
+    # Lưu thời điểm gửi tiếp theo (UTC) để bộ lập lịch tìm người cần gửi bằng chỉ mục
+    setting['lan_gui_tiep'] = next_digest_time(setting, datetime.now(timezone.utc))
+    ban_tin_collection.update_one({'_id': user_id}, {'$set': setting}, upsert=True)
+    
+    lich = 'mỗi ngày' if tan_suat == 'ngay' else 'mỗi Chủ nhật'
+    await update.message.reply_text(f'✅ Bot sẽ gửi bản tin chi tiêu {lich} lúc {gio}h ({mui_gio})')
+
+async def xem_ban_tin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Xem cài đặt bản tin."""
+    reply = update.message or update.callback_query.message
+    setting = ban_tin_collection.find_one({'_id': update.effective_user.id})
+    
+    if setting and setting.get('bat'):
+        lich = 'mỗi ngày' if setting['tan_suat'] == 'ngay' else 'mỗi Chủ nhật'
+        message = f'🌙 Bản tin chi tiêu: {lich} lúc {setting["gio"]}h ({setting["mui_gio"]})\n\n'
+    else:
+        message = '🌙 Bạn chưa bật bản tin chi tiêu tự động\n\n'
+    message += (
+        'Cài đặt theo định dạng: ban_tin [ngay|tuan] [giờ] [múi giờ]\n'
+        'Ví dụ: ban_tin ngay 21, ban_tin tuan 20 Asia/Bangkok\n'
+        'Tắt bản tin: ban_tin tat'
+    )
+    await reply.reply_text(message)
+
+def next_digest_time(setting: dict, after: datetime) -> datetime:
+    """Thời điểm gửi bản tin tiếp theo (UTC) sau `after`, tính theo giờ địa phương của người dùng.
+
+    Tính lại mỗi lần gửi nên vẫn đúng giờ sau khi đổi giờ mùa hè và với múi giờ lệch nửa tiếng.
+    """
+    local = after.astimezone(ZoneInfo(setting['mui_gio']))
+    candidate = local.replace(hour=setting['gio'], minute=0, second=0, microsecond=0)
+    step = timedelta(days=1)
+    if setting['tan_suat'] == 'tuan':
+        candidate += timedelta(days=(DIGEST_WEEKDAY - candidate.weekday()) % 7)
+        step = timedelta(days=7)
+    while candidate <= local:
+        candidate += step
+    return candidate.astimezone(timezone.utc)
+
+def claim_due_digests(now_utc: datetime):
+    """Tìm và đánh dấu những người dùng đã đến giờ nhận bản tin, theo từng lô.
+
+    Người dùng đến hạn là người có lan_gui_tiep <= now_utc, kể cả khi lượt trước
+    chưa kịp xử lý hết. Mỗi người được chuyển lan_gui_tiep sang lần gửi sau trước
+    khi gửi, nên khởi động lại bot không gửi trùng (nếu gửi lỗi thì bỏ qua lần đó).
+    """
+    due = ban_tin_collection.find(
+        {'bat': True, 'lan_gui_tiep': {'$lte': now_utc}},
+        {'_id': 1, 'tan_suat': 1, 'gio': 1, 'mui_gio': 1, 'lan_gui_tiep': 1}
+    ).sort('lan_gui_tiep', 1)
+    
+    chunk = []
+    for setting in due:
+        chunk.append(setting)
+        if len(chunk) == DIGEST_BATCH_SIZE:
+            yield claim_digest_chunk(chunk, now_utc)
+            chunk = []
+    if chunk:
+        yield claim_digest_chunk(chunk, now_utc)
+
+def claim_digest_chunk(settings: list, now_utc: datetime) -> list:
+    token = uuid.uuid4().hex
+    ban_tin_collection.bulk_write([
+        UpdateOne(
+            # Chỉ nhận nếu chưa có process nào khác nhận lần gửi này
+            {'_id': setting['_id'], 'lan_gui_tiep': setting['lan_gui_tiep']},
+            {'$set': {
+                'lan_gui_cuoi': setting['lan_gui_tiep'],
+                'lan_gui_tiep': next_digest_time(setting, now_utc),
+                'lan_gui_id': token
+            }}
+        )
+        for setting in settings
+    ], ordered=False)
+    return list(ban_tin_collection.find({'_id': {'$in': [s['_id'] for s in settings]}, 'lan_gui_id': token}))
+
+def digest_days(setting: dict) -> list:
+    """Các ngày (theo giờ địa phương của người dùng) có trong bản tin.
+
+    Ngày cuối là ngày chứa thời điểm ngay trước giờ gửi: bản tin gửi lúc 0h
+    tổng kết ngày vừa hết, không phải ngày mới bắt đầu (chưa có chi tiêu).
+    """
+    due = setting['lan_gui_cuoi'].replace(tzinfo=timezone.utc).astimezone(ZoneInfo(setting['mui_gio']))
+    last_day = (due - timedelta(seconds=1)).date()
+    count = 1 if setting['tan_suat'] == 'ngay' else 7
+    return [last_day - timedelta(days=i) for i in range(count - 1, -1, -1)]
+
+def local_day_bounds(day, zone: ZoneInfo):
+    """Đầu và cuối một ngày theo múi giờ của người dùng, đổi sang giờ server (như created_at)."""
+    start = datetime.combine(day, datetime.min.time(), tzinfo=zone)
+    end = datetime.combine(day + timedelta(days=1), datetime.min.time(), tzinfo=zone)
+    return start.astimezone().replace(tzinfo=None), end.astimezone().replace(tzinfo=None)
+
+def summary_hours(days: list, zone: ZoneInfo):
+    """Các giờ server (như created_at) nằm trong các ngày của người dùng.
+
+    Trả về None nếu đầu hoặc cuối ngày không rơi vào đầu giờ server (múi giờ lệch
+    nửa tiếng), khi đó tổng theo giờ trong tong_danh_muc không dùng được.
+    """
+    start, _ = local_day_bounds(days[0], zone)
+    _, end = local_day_bounds(days[-1], zone)
+    if start.minute or end.minute:
+        return None
+    return [start + timedelta(hours=i) for i in range((end - start) // timedelta(hours=1))]
+
+def ledger_category_totals(user_id, days: list, zone: ZoneInfo) -> dict:
+    """Tổng chi theo danh mục trong các ngày của người dùng, đọc từ sổ chi tiêu."""
+    start, _ = local_day_bounds(days[0], zone)
+    _, end = local_day_bounds(days[-1], zone)
+    chi_tieu = get_report_collection(user_id).aggregate([
+        {'$match': {'user_id': user_id, 'so_tien': {'$lt': 0}, 'created_at': {'$gte': start, '$lt': end}}},
+        {'$group': {'_id': '$danh_muc', 'tong': {'$sum': '$so_tien'}}}
+    ])
+    tong = {}
+    for ct in chi_tieu:
+        danh_muc = ct['_id'] or 'Khác'
+        tong[danh_muc] = tong.get(danh_muc, 0) - ct['tong']
+    return tong
+
+def build_digests(settings: list) -> list:
+    """Tạo nội dung bản tin cho một lô người dùng bằng một lần đọc tong_danh_muc.
+
+    tong_danh_muc lưu tổng theo từng giờ server nên ngày địa phương của mọi múi
+    giờ lệch tròn giờ đều ghép được từ các giờ đó. Chỉ múi giờ lệch nửa tiếng
+    mới phải tính từ sổ chi tiêu.
+    """
+    plans = []
+    summary_ids = set()
+    for setting in settings:
+        zone = ZoneInfo(setting['mui_gio'])
+        days = digest_days(setting)
+        hours = summary_hours(days, zone)
+        plans.append((setting, zone, days, hours))
+        # Tháng của ngày cuối luôn được đọc để lấy số dư
+        months = {days[-1].strftime('%Y-%m')} | {h.strftime('%Y-%m') for h in hours or []}
+        summary_ids |= {category_total_id(setting['_id'], m) for m in months}
+    summaries = {
+        doc['_id']: doc
+        for doc in tong_danh_muc_report_collection.find({'_id': {'$in': list(summary_ids)}}, {'ngay': 1, 'so_du': 1})
+    }
+    
+    messages = []
+    for setting, zone, days, hours in plans:
+        user_id = setting['_id']
+        if hours is not None:
+            tong_theo_danh_muc = {}
+            for hour in hours:
+                doc = summaries.get(category_total_id(user_id, hour.strftime('%Y-%m')), {})
+                for danh_muc, so_tien in doc.get('ngay', {}).get(hour.strftime('%d'), {}).get(hour.strftime('%H'), {}).items():
+                    tong_theo_danh_muc[danh_muc] = tong_theo_danh_muc.get(danh_muc, 0) + so_tien
+        else:
+            tong_theo_danh_muc = ledger_category_totals(user_id, days, zone)
+        tong_chi_tieu = sum(tong_theo_danh_muc.values())
+        
+        if setting['tan_suat'] == 'ngay':
+            message = f'🌙 Bản tin chi tiêu ngày {days[-1].strftime("%d/%m/%Y")}:\n\n'
+        else:
+            message = f'📅 Bản tin chi tiêu tuần {days[0].strftime("%d/%m")} - {days[-1].strftime("%d/%m/%Y")}:\n\n'
+        
+        if tong_chi_tieu:
+            message += f'💸 Tổng chi tiêu: {tong_chi_tieu:,}đ\n\n🏆 Chi nhiều nhất:\n'
+            for danh_muc, so_tien in sorted(tong_theo_danh_muc.items(), key=lambda x: x[1], reverse=True)[:3]:
+                message += f'  {CATEGORY_EMOJIS.get(danh_muc, "📌")} {danh_muc}: {so_tien:,}đ\n'
+        else:
+            message += '🎉 Bạn chưa chi tiêu khoản nào!\n'
+        
+        current = summaries.get(category_total_id(user_id, days[-1].strftime('%Y-%m')), {})
+        if 'so_du' in current:
+            message += f'\n💎 Số dư còn lại: {current["so_du"]:,}đ'
+        messages.append((setting['chat_id'], user_id, message))
+    return messages
+
+def prepare_digests(now_utc: datetime) -> list:
+    messages = []
+    for settings in claim_due_digests(now_utc):
+        messages += build_digests(settings)
+    return messages
+
+async def send_digest(bot, chat_id, user_id, text) -> bool:
+    """Gửi một bản tin, thử lại khi Telegram yêu cầu chờ."""
+    for _ in range(3):
+        try:
+            await bot.send_message(chat_id, text)
+            return True
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Forbidden:
+            # Người dùng đã chặn bot, tắt bản tin
+            ban_tin_collection.update_one({'_id': user_id}, {'$set': {'bat': False}})
+            break
+        except Exception as e:
+            logger.warning(f'Không gửi được bản tin cho user {user_id}: {e}')
+            break
+    return False
+
+async def digest_sender(bot, queue: asyncio.Queue):
+    """Gửi các bản tin trong hàng đợi với tốc độ tối đa DIGEST_RATE_PER_S tin mỗi giây."""
+    result = {'sent': 0, 'failed': 0}
+    tasks = set()
+    started_at = None
+    
+    def done(task):
+        tasks.discard(task)
+        result['sent' if task.result() else 'failed'] += 1
+        if not tasks and queue.empty():
+            logger.info(
+                '📨 Đã gửi %d bản tin (lỗi %d) trong %.1f s',
+                result['sent'], result['failed'], time.perf_counter() - started_at
+            )
+            result['sent'] = result['failed'] = 0
+    
+    while True:
+        message = await queue.get()
+        if not tasks:
+            started_at = time.perf_counter()
+        task = asyncio.create_task(send_digest(bot, *message))
+        tasks.add(task)
+        task.add_done_callback(done)
+        await asyncio.sleep(1 / DIGEST_RATE_PER_S)
+
+async def digest_scheduler(application: Application):
+    """Định kỳ nhận những người dùng đến giờ nhận bản tin và đưa bản tin vào hàng đợi gửi.
+
+    Việc gửi chạy ở task riêng nên một lượt gửi dài không làm trễ lượt nhận tiếp theo.
+    """
+    queue = asyncio.Queue()
+    sender = asyncio.create_task(digest_sender(application.bot, queue))
+    try:
+        while True:
+            try:
+                started_at = time.perf_counter()
+                messages = await asyncio.to_thread(prepare_digests, datetime.now(timezone.utc))
+                if messages:
+                    for message in messages:
+                        queue.put_nowait(message)
+                    logger.info(
+                        '📨 Bản tin: %d người dùng, tính trong %.2f s, %d tin đang chờ gửi',
+                        len(messages), time.perf_counter() - started_at, queue.qsize()
+                    )
+            except Exception as e:
+                logger.error(f'❌ Lỗi khi chuẩn bị bản tin: {e}')
+            await asyncio.sleep(DIGEST_INTERVAL_S)
+    finally:
+        sender.cancel()
+
+async def post_init(application: Application):
+    """Khởi động các tác vụ nền."""
+    global digest_task
+    if DIGEST_ENABLED:
+        digest_task = asyncio.create_task(digest_scheduler(application))
+
+async def post_shutdown(application: Application):
+    """Dọn dẹp khi tắt bot."""
+    if digest_task:
+        digest_task.cancel()
+    if expense_queue:
+        await expense_queue.close()
+
+def build_application(polling: bool = True) -> Application:
+    """Tạo Application và đăng ký các handler.
+
+    polling=False dùng cho worker trong cluster.py: update được đưa vào từ ingress thay vì getUpdates.
+    """
     # Create the Application and pass it your bot's token
-    application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+    builder = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        # Group commit cần xử lý nhiều update song song để gom được lô
+        .concurrent_updates(GROUP_COMMIT)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not polling:
+        builder = builder.updater(None)
+    application = builder.build()
 
     # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CommandHandler("start", track_db_usage(start)))
+    # block=False để lần bấm nút trùng nhau chạy song song và được run_report báo "đang xử lý".
+    # Worker trong cluster.py tự chạy song song giữa các người dùng và cần chờ handler xong
+    # để giữ thứ tự theo người dùng, nên chỉ dùng block=False khi polling.
+    application.add_handler(CallbackQueryHandler(track_db_usage(button_handler), block=not polling))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, track_db_usage(handle_message)))
+    return application
+
+def main():
+    """Start the bot."""
+    application = build_application()
 
     # Start the Bot
     application.run_polling()
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,370 @@
+"""Chạy bot với nhiều worker process, chia người dùng theo user_id.
+
+Một ingress duy nhất gọi getUpdates và chuyển từng update tới worker theo
+consistent hashing trên effective_user.id, nên mọi update của một người dùng
+luôn được xử lý bởi cùng một worker (không có hai process cùng cập nhật số dư
+trong thuchi_{user_id}).
+
+Cách dùng:
+    python cluster.py --workers 4
+
+Thêm/bớt worker khi đang chạy:
+    kill -USR1 <pid ingress>   # thêm một worker
+    kill -USR2 <pid ingress>   # bớt một worker
+"""
+import os
+import sys
+import signal
+import asyncio
+import bisect
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from dotenv import load_dotenv
+from telegram import Bot, Update
+
+load_dotenv()
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+logging.getLogger('httpx').setLevel(logging.ERROR)
+logging.getLogger('telegram').setLevel(logging.ERROR)
+
+VIRTUAL_NODES = 100  # Số điểm của mỗi worker trên vòng hash
+BARRIER_TIMEOUT_S = 60  # Thời gian chờ worker xử lý xong trước khi chia lại
+RESPAWN_DELAY_S = 1  # Thời gian chờ trước khi khởi động lại worker bị chết
+
+class HashRing:
+    """Consistent hashing: thêm/bớt một worker chỉ chuyển khoảng 1/N người dùng."""
+
+    def __init__(self, names=()):
+        self.points = []  # Danh sách (hash, tên worker) đã sắp xếp
+        self.names = set()
+        for name in names:
+            self.add(name)
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def add(self, name: str):
+        self.names.add(name)
+        for i in range(VIRTUAL_NODES):
+            bisect.insort(self.points, (self.hash(f'{name}#{i}'), name))
+
+    def remove(self, name: str):
+        self.names.discard(name)
+        self.points = [point for point in self.points if point[1] != name]
+
+    def get(self, key) -> str:
+        index = bisect.bisect(self.points, (self.hash(str(key)), ''))
+        return self.points[index % len(self.points)][1]
+
+def routing_key(update: Update):
+    """Khóa chia update: user_id, nếu không có thì chat_id."""
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return 0
+
+def run_worker(name: str, queue, ack_conn):
+    """Điểm vào của worker process."""
+    # Ctrl+C chỉ do ingress xử lý, worker dừng khi nhận None từ hàng đợi
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(worker_loop(name, queue, ack_conn))
+
+async def worker_loop(name: str, queue, ack_conn):
+    """Nhận update từ ingress và xử lý bằng các handler trong bot.py.
+
+    Mỗi update xử lý xong được báo lại cho ingress qua ack_conn ('done', update_id).
+    """
+    import bot  # Import trong process con: mỗi worker có kết nối MongoDB riêng
+
+    # Handler chạy blocking: process_update chỉ trả về khi handler đã xong,
+    # nên thứ tự theo người dùng và barrier bao gồm cả các nút báo cáo
+    application = bot.build_application(polling=False)
+    loop = asyncio.get_running_loop()
+    user_tasks = {}  # routing key -> task của update gần nhất, để giữ thứ tự theo người dùng
+    # (user_id, nút) của các báo cáo đang chờ hoặc đang chạy. Update của một người dùng được xử lý
+    # lần lượt nên run_report không thấy lần bấm trùng, cần bỏ qua ngay khi nhận
+    queued_reports = set()
+    reply_tasks = set()  # Các task trả lời lần bấm trùng
+
+    def forget_task(key, task):
+        if user_tasks.get(key) is task:
+            del user_tasks[key]
+
+    async def process_in_order(previous, update, report_key):
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            await application.process_update(update)
+        finally:
+            queued_reports.discard(report_key)
+            ack_conn.send(('done', update.update_id))
+
+    async def reject_duplicate(update):
+        try:
+            await update.callback_query.answer('⏳ Đang xử lý, vui lòng chờ trong giây lát...')
+        except Exception as e:
+            logger.warning(f'Không trả lời được callback trùng: {e}')
+        finally:
+            ack_conn.send(('done', update.update_id))
+
+    async with application:
+        await application.start()
+        if name == 'worker-0':
+            # Tác vụ nền (bản tin) chỉ chạy ở một worker
+            await bot.post_init(application)
+        logger.info(f'✅ {name} đã sẵn sàng (pid {os.getpid()})')
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+
+            kind, payload = item
+            if kind == 'barrier':
+                # Xử lý xong mọi update đã nhận rồi mới báo cho ingress
+                await asyncio.gather(*user_tasks.values(), *reply_tasks, return_exceptions=True)
+                user_tasks.clear()
+                ack_conn.send(('barrier', payload))
+                continue
+
+            update = Update.de_json(payload, application.bot)
+            key = routing_key(update)
+            report_key = None
+            if update.callback_query and bot.report_button(update.callback_query.data or ''):
+                report_key = (key, update.callback_query.data)
+                if report_key in queued_reports:
+                    reply_task = asyncio.create_task(reject_duplicate(update))
+                    reply_tasks.add(reply_task)
+                    reply_task.add_done_callback(reply_tasks.discard)
+                    continue
+                queued_reports.add(report_key)
+            task = asyncio.create_task(process_in_order(user_tasks.get(key), update, report_key))
+            user_tasks[key] = task
+            task.add_done_callback(lambda t, key=key: forget_task(key, t))
+
+        await asyncio.gather(*user_tasks.values(), *reply_tasks, return_exceptions=True)
+        await bot.post_shutdown(application)
+        await application.stop()
+    logger.info(f'👋 {name} đã dừng')
+
+class WorkerDied(Exception):
+    """Worker process dừng bất thường."""
+
+class Worker:
+    """Một worker process cùng hàng đợi update và pipe báo kết quả của nó."""
+
+    def __init__(self, context, name: str):
+        self.name = name
+        self.queue = context.Queue()
+        self.acks, ack_writer = context.Pipe(duplex=False)
+        self.process = context.Process(target=run_worker, args=(name, self.queue, ack_writer), name=name)
+        self.process.start()
+        # Chỉ worker giữ đầu ghi, để ingress nhận EOF ngay khi worker dừng
+        ack_writer.close()
+        self.pending = {}  # update_id -> update đã gửi nhưng chưa xử lý xong, theo thứ tự gửi
+        self.barriers = {}  # barrier_id -> future chờ worker báo xong
+        self.retiring = False  # Đang được dừng chủ động, không khởi động lại
+        self.closed = False
+
+    def send(self, item):
+        # Update gửi tới worker đã chết vẫn nằm trong pending và sẽ được gửi lại
+        if not self.closed:
+            self.queue.put(item)
+
+    def discard_queue(self):
+        """Bỏ hàng đợi mà không chờ đẩy hết dữ liệu (worker đọc nó đã dừng)."""
+        if not self.closed:
+            self.closed = True
+            self.queue.cancel_join_thread()
+            self.queue.close()
+
+class Ingress:
+    """Poller duy nhất, chia update cho các worker qua multiprocessing.Queue.
+
+    Update chỉ được xóa khỏi danh sách chờ của worker khi worker báo đã xử lý
+    xong. Nếu worker chết, ingress khởi động lại worker cùng tên và gửi lại các
+    update chưa xong (update đang xử lý dở có thể bị xử lý lại). Update còn
+    trong hàng đợi khi chính ingress dừng đột ngột sẽ mất, giống run_polling.
+    """
+
+    def __init__(self, token: str):
+        self.token = token
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {}  # tên -> Worker
+        self.ring = HashRing()
+        self.next_id = 0
+        self.barrier_id = 0
+        self.topology_lock = asyncio.Lock()
+        self.stopping = asyncio.Event()
+
+    def start_worker(self, name: str = None) -> Worker:
+        if name is None:
+            name = f'worker-{self.next_id}'
+            self.next_id += 1
+        worker = Worker(self.context, name)
+        self.workers[name] = worker
+        asyncio.get_running_loop().add_reader(worker.acks.fileno(), self.read_acks, worker)
+        return worker
+
+    def read_acks(self, worker: Worker):
+        """Đọc các báo cáo từ worker, EOF nghĩa là worker đã dừng."""
+        try:
+            while worker.acks.poll():
+                kind, value = worker.acks.recv()
+                if kind == 'done':
+                    worker.pending.pop(value, None)
+                elif kind == 'barrier':
+                    future = worker.barriers.pop(value, None)
+                    if future and not future.done():
+                        future.set_result(None)
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(worker.acks.fileno())
+            worker.acks.close()
+            if not worker.retiring and not self.stopping.is_set():
+                asyncio.ensure_future(self.respawn(worker))
+
+    async def respawn(self, worker: Worker):
+        """Khởi động lại worker đã chết với cùng tên (không đổi vòng hash) và gửi lại các update chưa xong."""
+        await asyncio.get_running_loop().run_in_executor(None, worker.process.join)
+        logger.error(f'❌ {worker.name} đã dừng bất thường (exit code {worker.process.exitcode}), '
+                     f'khởi động lại với {len(worker.pending)} update chưa xử lý')
+        # Tránh khởi động lại liên tục nếu worker lỗi ngay khi chạy
+        await asyncio.sleep(RESPAWN_DELAY_S)
+        worker.discard_queue()
+        if self.stopping.is_set() or self.workers.get(worker.name) is not worker:
+            for future in worker.barriers.values():
+                if not future.done():
+                    future.set_exception(WorkerDied(worker.name))
+            return
+
+        replacement = self.start_worker(worker.name)
+        replacement.pending = worker.pending
+        for payload in replacement.pending.values():
+            replacement.send(('update', payload))
+        # Barrier đang chờ worker cũ được chuyển sang worker mới, sau các update gửi lại
+        for barrier_id, future in worker.barriers.items():
+            replacement.barriers[barrier_id] = future
+            replacement.send(('barrier', barrier_id))
+
+    async def stop_worker(self, worker: Worker, terminate: bool = False):
+        """Dừng chủ động một worker: chờ nó xử lý nốt hàng đợi, hoặc dừng ngay nếu terminate."""
+        worker.retiring = True
+        if self.workers.get(worker.name) is worker:
+            del self.workers[worker.name]
+        if terminate:
+            worker.process.terminate()
+        else:
+            worker.send(None)
+        await asyncio.get_running_loop().run_in_executor(None, worker.process.join)
+        worker.discard_queue()
+
+    async def barrier(self):
+        """Chờ mọi worker xử lý xong các update đã nhận, để người dùng bị chuyển không bị xử lý song song."""
+        self.barrier_id += 1
+        barrier_id = self.barrier_id
+        loop = asyncio.get_running_loop()
+        waiting = []
+        for name in self.ring.names:
+            worker = self.workers[name]
+            future = loop.create_future()
+            worker.barriers[barrier_id] = future
+            worker.send(('barrier', barrier_id))
+            waiting.append(future)
+        try:
+            await asyncio.wait_for(asyncio.gather(*waiting), BARRIER_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Worker không phản hồi barrier') from None
+        finally:
+            for worker in self.workers.values():
+                worker.barriers.pop(barrier_id, None)
+
+    async def add_worker(self):
+        async with self.topology_lock:
+            worker = self.start_worker()
+            try:
+                await self.barrier()
+            except (TimeoutError, WorkerDied) as e:
+                # Worker mới chưa nhận người dùng nào, dừng ngay để không chạy ngoài vòng hash
+                logger.error(f'❌ Không thể thêm {worker.name}: {e}')
+                await self.stop_worker(worker, terminate=True)
+                return
+            self.ring.add(worker.name)
+            logger.info(f'➕ Đã thêm {worker.name}, hiện có {len(self.workers)} worker')
+
+    async def remove_worker(self):
+        async with self.topology_lock:
+            if len(self.workers) <= 1:
+                logger.warning('Không thể bớt worker cuối cùng')
+                return
+            name = list(self.workers)[-1]
+            try:
+                await self.barrier()
+            except (TimeoutError, WorkerDied) as e:
+                logger.error(f'❌ Không thể bớt {name}: {e}')
+                return
+            self.ring.remove(name)
+            await self.stop_worker(self.workers[name])
+            logger.info(f'➖ Đã bớt {name}, hiện có {len(self.workers)} worker')
+
+    def dispatch(self, update: Update):
+        worker = self.workers[self.ring.get(routing_key(update))]
+        payload = update.to_dict()
+        worker.pending[update.update_id] = payload
+        worker.send(('update', payload))
+
+    async def poll(self):
+        async with Bot(self.token) as telegram_bot:
+            offset = None
+            while not self.stopping.is_set():
+                try:
+                    updates = await telegram_bot.get_updates(
+                        offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES
+                    )
+                except Exception as e:
+                    logger.error(f'❌ Lỗi khi lấy update: {e}')
+                    await asyncio.sleep(1)
+                    continue
+                async with self.topology_lock:
+                    for update in updates:
+                        self.dispatch(update)
+                        offset = update.update_id + 1
+
+    async def run(self, worker_count: int):
+        for _ in range(worker_count):
+            self.ring.add(self.start_worker().name)
+
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(self.add_worker()))
+        loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(self.remove_worker()))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        logger.info(f'✅ Ingress đang chạy (pid {os.getpid()}) với {worker_count} worker')
+        poller = asyncio.create_task(self.poll())
+        await self.stopping.wait()
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+
+        # Worker xử lý nốt hàng đợi rồi dừng
+        await asyncio.gather(*(self.stop_worker(worker) for worker in list(self.workers.values())))
+
+def main():
+    parser = argparse.ArgumentParser(description='Chạy bot với nhiều worker process')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BOT_WORKERS', 2)),
+                        help='Số worker ban đầu (mặc định 2)')
+    args = parser.parse_args()
+    if args.workers < 1:
+        sys.exit('Số worker phải lớn hơn 0')
+
+    asyncio.run(Ingress(os.getenv('TELEGRAM_BOT_TOKEN')).run(args.workers))
+
+if __name__ == '__main__':
+    main()
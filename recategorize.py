@@ -0,0 +1,203 @@
+"""Phân loại lại chi tiêu cũ sau khi thêm/sửa từ khóa.
+
+Job đọc lần lượt từng lô chi tiêu trong các collection thuchi_{user_id}, phân
+loại lại bằng cùng quy tắc với get_expense_category (dùng bộ từ khóa tải sẵn
+một lần) và chỉ ghi những bản ghi có danh mục thay đổi bằng bulk_write. Các
+collection được chia cho nhiều process, tiến độ được lưu vào collection
+phan_loai_lai nên có thể chạy lại để tiếp tục.
+
+Cách dùng:
+    python recategorize.py --dry-run          # chỉ thống kê số bản ghi sẽ đổi
+    python recategorize.py --workers 4        # phân loại lại các chi tiêu 'Khác'
+    python recategorize.py --all              # phân loại lại toàn bộ chi tiêu
+    python recategorize.py --restart          # bỏ tiến độ cũ, chạy lại từ đầu
+"""
+import hashlib
+import argparse
+import multiprocessing
+from datetime import datetime
+from pymongo import UpdateOne
+
+import bot
+
+CHECKPOINT_COLLECTION = 'phan_loai_lai'
+
+# Cấu hình của process con, được gán trong init_worker
+job = {}
+
+def expense_filter(all_expenses: bool) -> dict:
+    """Điều kiện chọn các chi tiêu cần phân loại lại."""
+    dieu_kien = {'so_tien': {'$lt': 0}, 'mo_ta': {'$exists': True}}
+    if not all_expenses:
+        dieu_kien['danh_muc'] = {'$in': ['Khác', None]}
+    return dieu_kien
+
+def job_version(keywords: list, dieu_kien: dict) -> str:
+    """Hash của bộ từ khóa và điều kiện lọc: một trong hai thay đổi thì tiến độ cũ không còn giá trị."""
+    return hashlib.md5(repr((keywords, dieu_kien)).encode()).hexdigest()
+
+def init_worker(keywords: list, options: dict):
+    job.update(options)
+    job['keywords'] = keywords
+    job['filter'] = expense_filter(options['all'])
+    job['version'] = job_version(keywords, job['filter'])
+
+def add_delta(deltas: dict, month: str, ct: dict, cu: str, moi: str):
+    """Ghi lại thay đổi của tổng theo danh mục và theo giờ khi chuyển một chi tiêu từ cu sang moi."""
+    delta = deltas.setdefault(month, {})
+    so_tien = -ct['so_tien']
+    gio = ct['created_at'].strftime('%d.%H')
+    for field, amount in ((f'tong.{cu}', -so_tien), (f'tong.{moi}', so_tien),
+                          (f'ngay.{gio}.{cu}', -so_tien), (f'ngay.{gio}.{moi}', so_tien)):
+        delta[field] = delta.get(field, 0) + amount
+
+def process_collection(collection_name: str) -> dict:
+    """Phân loại lại một collection, trả về thống kê {'scanned', 'changed', 'transitions'}."""
+    collection = bot.db[collection_name]
+    checkpoints = bot.db[CHECKPOINT_COLLECTION]
+    user_id = int(collection_name[len('thuchi_'):])
+
+    stats = {'collection': collection_name, 'scanned': 0, 'changed': 0, 'transitions': {}}
+    last_id = None
+    if not job['dry_run']:
+        checkpoint = checkpoints.find_one({'_id': collection_name})
+        if checkpoint and checkpoint.get('version') == job['version']:
+            if checkpoint.get('done'):
+                stats['skipped'] = True
+                return stats
+            last_id = checkpoint.get('last_id')
+            stats['scanned'] = checkpoint.get('scanned', 0)
+            stats['changed'] = checkpoint.get('changed', 0)
+
+    # Tháng hiện tại vẫn đang nhận chi tiêu mới từ bot, không tính lại tổng của tháng này
+    current_month = datetime.now().strftime('%Y-%m')
+    changed_months = set()
+    while True:
+        batch_filter = dict(job['filter'])
+        if last_id is not None:
+            batch_filter['_id'] = {'$gt': last_id}
+        batch = list(
+            collection.find(batch_filter, {'mo_ta': 1, 'danh_muc': 1, 'month': 1, 'so_tien': 1, 'created_at': 1})
+            .sort('_id', 1)
+            .limit(job['batch_size'])
+        )
+        if not batch:
+            break
+
+        requests = []
+        current_changes = []  # (chi tiêu, danh mục cũ, danh mục mới) của tháng hiện tại
+        batch_months = set()
+        for ct in batch:
+            cu = ct.get('danh_muc', 'Khác')
+            moi = bot.classify_expense(ct['mo_ta'], job['keywords'])
+            if moi != cu:
+                transition = f'{cu} -> {moi}'
+                stats['transitions'][transition] = stats['transitions'].get(transition, 0) + 1
+                if ct.get('month') == current_month:
+                    current_changes.append((ct, cu, moi))
+                    continue
+                batch_months.add(ct.get('month'))
+                # Chỉ ghi nếu danh mục chưa bị đổi bởi thao tác khác trong lúc job chạy
+                requests.append(UpdateOne(
+                    {'_id': ct['_id'], 'danh_muc': ct.get('danh_muc')},
+                    {'$set': {'danh_muc': moi}}
+                ))
+
+        stats['scanned'] += len(batch)
+        stats['changed'] += len(requests) + len(current_changes)
+        last_id = batch[-1]['_id']
+        changed_months |= batch_months
+
+        if not job['dry_run']:
+            if requests:
+                collection.bulk_write(requests, ordered=False)
+            if current_changes:
+                # Tháng hiện tại: ghi từng bản ghi để biết chắc bản ghi nào đã đổi, rồi cộng
+                # phần chênh lệch bằng $inc để không ghi đè các chi tiêu bot đang cộng vào
+                deltas = {}
+                for ct, cu, moi in current_changes:
+                    result = collection.update_one(
+                        {'_id': ct['_id'], 'danh_muc': ct.get('danh_muc')},
+                        {'$set': {'danh_muc': moi}}
+                    )
+                    if result.modified_count:
+                        add_delta(deltas, current_month, ct, cu or 'Khác', moi)
+                for month, delta in deltas.items():
+                    bot.tong_danh_muc_collection.update_one(
+                        {'_id': bot.category_total_id(user_id, month)},
+                        {'$inc': delta}
+                    )
+            checkpoints.update_one(
+                {'_id': collection_name},
+                {
+                    '$set': {
+                        'version': job['version'],
+                        'last_id': last_id,
+                        'scanned': stats['scanned'],
+                        'changed': stats['changed'],
+                        'done': False
+                    },
+                    # Lưu các tháng bị đổi để lần chạy tiếp theo vẫn cập nhật đủ bản tổng hợp
+                    '$addToSet': {'months': {'$each': sorted(m for m in batch_months if m)}}
+                },
+                upsert=True
+            )
+
+    if not job['dry_run']:
+        checkpoint = checkpoints.find_one({'_id': collection_name}) or {}
+        changed_months |= set(checkpoint.get('months', []))
+        # Tính lại bản tổng hợp (ngân sách, xu hướng) của các tháng đã kết thúc bị ảnh hưởng
+        for month in changed_months - {None, current_month}:
+            bot.tong_danh_muc_collection.update_one(
+                {'_id': bot.category_total_id(user_id, month)},
+                {'$set': {
+                    'tong': bot.compute_category_totals(user_id, month),
+                    'ngay': bot.compute_daily_totals(user_id, month)
+                }}
+            )
+        checkpoints.update_one({'_id': collection_name}, {'$set': {'done': True}}, upsert=True)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Phân loại lại chi tiêu cũ theo bộ từ khóa hiện tại')
+    parser.add_argument('--dry-run', action='store_true', help='Chỉ thống kê, không ghi dữ liệu')
+    parser.add_argument('--all', action='store_true', help="Phân loại lại mọi chi tiêu, không chỉ 'Khác'")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='Số process')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Số bản ghi mỗi lô')
+    parser.add_argument('--restart', action='store_true', help='Bỏ tiến độ đã lưu và chạy lại từ đầu')
+    args = parser.parse_args()
+
+    keywords = bot.load_keywords()
+    if not keywords:
+        print('❌ Chưa có từ khóa nào!')
+        return
+
+    if args.restart and not args.dry_run:
+        bot.db[CHECKPOINT_COLLECTION].delete_many({})
+
+    collection_names = sorted(bot.db.list_collection_names(filter={'name': {'$regex': r'^thuchi_\d+$'}}))
+    print(f'🔄 Phân loại lại {len(collection_names)} collection với {len(keywords)} từ khóa'
+          f'{" (dry run)" if args.dry_run else ""}...')
+
+    options = {'dry_run': args.dry_run, 'all': args.all, 'batch_size': args.batch_size}
+    # spawn để mỗi process có kết nối MongoDB riêng (MongoClient không an toàn khi fork)
+    context = multiprocessing.get_context('spawn')
+    tong = {'scanned': 0, 'changed': 0, 'transitions': {}}
+    with context.Pool(args.workers, initializer=init_worker, initargs=(keywords, options)) as pool:
+        for stats in pool.imap_unordered(process_collection, collection_names):
+            if stats.get('skipped'):
+                print(f'⏭️ {stats["collection"]}: đã xong từ lần chạy trước')
+                continue
+            print(f'✅ {stats["collection"]}: {stats["changed"]}/{stats["scanned"]} bản ghi đổi danh mục')
+            tong['scanned'] += stats['scanned']
+            tong['changed'] += stats['changed']
+            for transition, count in stats['transitions'].items():
+                tong['transitions'][transition] = tong['transitions'].get(transition, 0) + count
+
+    print(f'\n📊 Tổng: {tong["changed"]}/{tong["scanned"]} bản ghi '
+          f'{"sẽ được" if args.dry_run else "đã được"} đổi danh mục')
+    for transition, count in sorted(tong['transitions'].items(), key=lambda x: x[1], reverse=True):
+        print(f'  • {transition}: {count}')
+
+if __name__ == '__main__':
+    main()